@@ -0,0 +1,233 @@
+# import packages
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tensorflow as tf
+import numpy as np
+
+# import project functions
+import circuits
+from simulators import simulators, configure_cpu_devices
+
+#######################
+# benchmark suite for the quantum convolutional layers
+#
+# every case builds one layer for a random batch and times the forward pass and the forward and
+# backward pass under tf.function, after warmup calls that trace the functions. the median and
+# the minimum over the repeats are written to a json file together with the versions and the
+# machine, and a run can be compared with a stored baseline to flag regressions
+
+# the layers that are benchmarked, Q_U1_control is run with and without classical weights
+layers = ["U1_circuit", "U1_Modified_circuit", "Q_U1_control", "Q_U1_control_weighted"]
+
+# axes of the benchmark grid, registers, rdpa and inter_U only apply to the U1 layers, devices
+# shards the circuits across that many devices (logical cpus without a gpu)
+grid_defaults = {"layer": layers,
+                 "backend": list(simulators),
+                 "batch_size": [8, 32],
+                 "image_size": [6, 10],
+                 "channels": [3],
+                 "n_kernels": [1, 3],
+                 "registers": [1],
+                 "rdpa": [1],
+                 "inter_U": [False],
+                 "fused_kernels": [False],
+                 "devices": [None]}
+
+# axes added after the first baselines were stored, a case at these values is matched with the
+# baseline cases that do not have the axis
+neutral_values = {"fused_kernels": False, "devices": None}
+
+# backends that are not benchmarked for a layer, the symbolic derivation of the closed form
+# expectation of the U1 circuits takes longer than the whole benchmark
+unsupported = {"closed_form": ["U1_circuit", "U1_Modified_circuit"]}
+
+#############################
+# the cases of a grid, settings that do not apply to a layer are dropped and duplicates removed,
+# the U1 layers need the channels split evenly over the registers and the registers over the ancillas
+def get_cases(grid):
+    unknown = [k for k in grid if k not in grid_defaults]
+    if unknown:
+        raise ValueError("Unknown benchmark axes "+str(unknown)+", choose from "+str(list(grid_defaults)))
+    grid = dict(grid_defaults, **grid)
+    cases = []
+    for values in itertools.product(*[v if isinstance(v, list) else [v] for v in grid.values()]):
+        case = dict(zip(grid.keys(), values))
+        if case["layer"] in unsupported.get(case["backend"], []):
+            continue
+        if case["layer"].startswith("Q_U1_control"):
+            case = {k: v for k, v in case.items() if k not in ["registers", "rdpa", "inter_U"]}
+        elif case["channels"] % case["registers"] or case["registers"] % case["rdpa"]:
+            continue
+        if case not in cases:
+            cases.append(case)
+    return cases
+
+# the key a case is matched on when comparing runs
+def case_key(case):
+    return json.dumps({k: case[k] for k in grid_defaults if k in case and not (k in neutral_values and case[k] == neutral_values[k])}, sort_keys=True)
+
+def build_layer(case):
+    options = dict(backend=case["backend"], fused_kernels=case["fused_kernels"], devices=case["devices"])
+    if case["layer"] == "U1_circuit":
+        return circuits.U1_circuit(case["n_kernels"], case["channels"], 'CIFAR10', registers=case["registers"], rdpa=case["rdpa"], inter_U=case["inter_U"], **options)
+    if case["layer"] == "U1_Modified_circuit":
+        return circuits.U1_Modified_circuit(case["n_kernels"], case["channels"], 'CIFAR10', registers=case["registers"], rdpa=case["rdpa"], inter_U=case["inter_U"], **options)
+    return circuits.Q_U1_control(case["n_kernels"], 'CIFAR10', classical_weights=case["layer"] == "Q_U1_control_weighted", **options)
+
+# time a function of x, returns the median and minimum seconds of the repeats
+def time_function(function, x, warmup, repeats):
+    for _ in range(warmup):
+        function(x).numpy()
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(x).numpy()
+        seconds.append(time.perf_counter() - start)
+    return float(np.median(seconds)), float(np.min(seconds))
+
+# run a single case, failures (e.g. a backend that is not installed) are recorded with the error
+def run_case(case, warmup=1, repeats=5, seed=0):
+    tf.keras.utils.set_random_seed(seed)
+    x = tf.constant(np.random.default_rng(seed).random((case["batch_size"], case["image_size"], case["image_size"], case["channels"]), dtype=np.float32))
+    result = dict(case)
+    try:
+        start = time.perf_counter()
+        layer = build_layer(case)
+        layer.build(x.shape)
+        result["build_seconds"] = time.perf_counter() - start
+
+        forward = tf.function(lambda x: layer(x, training=False))
+
+        @tf.function
+        def forward_backward(x):
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_sum(layer(x, training=True)**2)
+            gradients = tape.gradient(loss, layer.trainable_weights)
+            return loss + tf.add_n([tf.reduce_sum(g) for g in gradients])
+
+        result["forward_seconds"], result["forward_min_seconds"] = time_function(forward, x, warmup, repeats)
+        result["backward_seconds"], result["backward_min_seconds"] = time_function(forward_backward, x, warmup, repeats)
+        result["forward_samples_per_second"] = case["batch_size"]/result["forward_seconds"]
+        result["backward_samples_per_second"] = case["batch_size"]/result["backward_seconds"]
+    except Exception as e:
+        result["error"] = type(e).__name__+": "+str(e).splitlines()[0] if str(e) else type(e).__name__
+    return result
+
+#############################
+# versions and machine the benchmark ran on, runs on other machines are not comparable
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {"python": sys.version.split()[0],
+            "tensorflow": tf.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "gpus": len(tf.config.list_physical_devices('GPU')),
+            "commit": commit}
+
+def run_benchmarks(grid, warmup=1, repeats=5, seed=0, output=None):
+    cases = get_cases(grid)
+    print("Benchmarking "+str(len(cases))+" cases")
+
+    # without a gpu the cpu is split into as many logical devices as the largest case shards
+    # across, before tensorflow is initialized
+    n_devices = max([case["devices"] or 0 for case in cases], default=0)
+    if n_devices > 1 and not tf.config.list_physical_devices('GPU'):
+        try:
+            configure_cpu_devices(n_devices)
+        except RuntimeError:
+            print("Warning: tensorflow is already initialized, the cases can only use the devices that exist")
+    results = []
+    for i, case in enumerate(cases):
+        result = run_case(case, warmup, repeats, seed)
+        results.append(result)
+        print(str(i+1)+"/"+str(len(cases))+" "+", ".join(k+"="+str(v) for k, v in case.items())+": "+
+              (result["error"] if "error" in result else "forward "+str(round(result["forward_seconds"]*1000, 2))+" ms, forward+backward "+str(round(result["backward_seconds"]*1000, 2))+" ms"))
+
+    if output is None:
+        os.makedirs('output', exist_ok=True)
+        output = 'output/'+time.strftime("%Y%m%d-%H%M%S")+'_benchmark.json'
+    with open(output, 'w') as f:
+        json.dump({"environment": environment(), "settings": {"grid": grid, "warmup": warmup, "repeats": repeats, "seed": seed}, "results": results}, f, indent=2)
+    print("Results written to "+output)
+    return output
+
+# compare two benchmark files, a case regressed when its median time grew by more than threshold
+# returns the regressed cases
+def compare(path, baseline_path, threshold=0.1):
+    with open(path) as f:
+        current = json.load(f)
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    changed = [k for k in ["tensorflow", "platform", "processor", "cpus", "gpus"] if current["environment"].get(k) != baseline["environment"].get(k)]
+    if changed:
+        print("Warning: the environment differs from the baseline in "+str(changed)+", timings may not be comparable")
+
+    baseline_results = {case_key(r): r for r in baseline["results"] if "error" not in r}
+    regressions = []
+    print("~~~~~~~~~~~COMPARISON~~~~~~~~~~")
+    for result in current["results"]:
+        key = case_key(result)
+        if "error" in result or key not in baseline_results:
+            continue
+        for measure in ["forward_seconds", "backward_seconds"]:
+            ratio = result[measure]/baseline_results[key][measure]
+            status = "REGRESSION" if ratio > 1 + threshold else "improved" if ratio < 1/(1 + threshold) else "ok"
+            print(status+" "+measure+" x"+str(round(ratio, 2))+" "+", ".join(k+"="+str(v) for k, v in json.loads(key).items()))
+            if status == "REGRESSION":
+                regressions.append(dict(json.loads(key), measure=measure, ratio=ratio))
+
+    missing = len(baseline_results) - len([r for r in current["results"] if case_key(r) in baseline_results and "error" not in r])
+    if missing:
+        print(str(missing)+" baseline cases were not measured")
+    print(str(len(regressions))+" regression(s) above "+str(int(threshold*100))+"%")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the forward and backward passes of the quantum layers.")
+    parser.add_argument("--config", help="json file with the benchmark grid, every axis is a list of values")
+    parser.add_argument("--layers", nargs="+", dest="layer", choices=layers)
+    parser.add_argument("--backends", nargs="+", dest="backend", choices=list(simulators))
+    parser.add_argument("--batch-sizes", nargs="+", type=int, dest="batch_size")
+    parser.add_argument("--image-sizes", nargs="+", type=int, dest="image_size")
+    parser.add_argument("--channels", nargs="+", type=int)
+    parser.add_argument("--n-kernels", nargs="+", type=int)
+    parser.add_argument("--registers", nargs="+", type=int)
+    parser.add_argument("--rdpa", nargs="+", type=int)
+    parser.add_argument("--inter-U", nargs="+", type=lambda v: v.lower() in ["1", "true", "y", "yes"], dest="inter_U")
+    parser.add_argument("--fused-kernels", nargs="+", type=lambda v: v.lower() in ["1", "true", "y", "yes"], help="evaluate all kernels in a single simulator call")
+    parser.add_argument("--devices", nargs="+", type=lambda v: None if v.lower() == "none" else int(v), help="devices the circuits are sharded across, none for no sharding")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed calls before timing, the first one traces the function")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="result file (default output/<time>_benchmark.json)")
+    parser.add_argument("--baseline", help="compare the results with this benchmark file, exits with 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown that counts as a regression")
+    parser.add_argument("--compare-only", metavar="RESULTS", help="compare an existing result file with --baseline instead of running")
+    args = parser.parse_args()
+
+    if args.compare_only:
+        path = args.compare_only
+    else:
+        grid = {}
+        if args.config:
+            with open(args.config) as f:
+                grid = json.load(f)
+        for key in grid_defaults:
+            if getattr(args, key) is not None:
+                grid[key] = getattr(args, key)
+        path = run_benchmarks(grid, args.warmup, args.repeats, args.seed, args.output)
+
+    if args.baseline:
+        sys.exit(1 if compare(path, args.baseline, args.threshold) else 0)
@@ -0,0 +1,97 @@
+# import packages
+import os
+import json
+import shutil
+import hashlib
+import tensorflow as tf
+
+# directory that holds the checkpoints of the training runs
+checkpoint_dir = 'checkpoints'
+
+# settings of a run that do not change what is trained, a run can be resumed with other values
+resumable_settings = ["epochs", "resume", "checkpoint_every", "devices", "cache_size", "overwrite", "profile", "trace",
+                      "workers", "threads_per_worker"]
+
+#######################
+# periodic checkpoints of a training run
+#
+# the weights of the model (the quantum kernels, channel_w and channel_b included), the state of
+# the optimizer and the number of completed epochs are written with tf.train.CheckpointManager
+# every few epochs, next to the history of the completed epochs. the directory is named after the
+# settings of the run, so rerunning the same settings with resume continues from the last
+# checkpoint instead of the first epoch
+
+# return the checkpoint directory of a run
+def checkpoint_path(run, name):
+    key = {k: v for k, v in run.items() if k not in resumable_settings}
+    return os.path.join(checkpoint_dir, name+'_'+hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:12])
+
+class Training_checkpoint(tf.keras.callbacks.Callback):
+
+    # initialize class, model and optimizer are the objects that are saved and restored, every is
+    # the number of epochs between checkpoints
+    def __init__(self, model, optimizer, path, every=1, max_to_keep=2):
+        super().__init__()
+        self.path = path
+        self.every = every
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer, epoch=self.epoch)
+        self.max_to_keep = max_to_keep
+        self.manager = tf.train.CheckpointManager(self.checkpoint, path, max_to_keep=max_to_keep)
+        self.history = {}
+        self.saved_epoch = 0
+
+    # whether the last training that used the checkpoint ran to its end
+    def finished(self):
+        return os.path.exists(os.path.join(self.path, 'finished'))
+
+    # restore the last checkpoint, returns the number of completed epochs to pass to fit as
+    # initial_epoch. without resume the checkpoint of a finished run is removed, the checkpoint
+    # of an unfinished run is only removed with overwrite
+    def restore(self, resume=True, overwrite=False):
+        if not resume:
+            if os.path.isdir(self.path) and os.listdir(self.path) and not self.finished() and not overwrite:
+                raise FileExistsError("An unfinished checkpoint of these settings exists in "+self.path+", resume it or set overwrite (--overwrite) to start over")
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.manager = tf.train.CheckpointManager(self.checkpoint, self.path, max_to_keep=self.max_to_keep)
+            return 0
+        if self.manager.latest_checkpoint is None:
+            return 0
+
+        # the history is written before the checkpoint and can be ahead of it after a crash
+        self.checkpoint.restore(self.manager.latest_checkpoint)
+        self.saved_epoch = int(self.epoch.numpy())
+        with open(os.path.join(self.path, 'history.json')) as f:
+            self.history = {k: v[:self.saved_epoch] for k, v in json.load(f).items()}
+        print("Resuming from "+self.manager.latest_checkpoint+" after epoch "+str(self.saved_epoch))
+        return self.saved_epoch
+
+    # the checkpoint is unfinished until the training ends
+    def on_train_begin(self, logs=None):
+        if self.finished():
+            os.remove(os.path.join(self.path, 'finished'))
+
+    def on_epoch_end(self, epoch, logs=None):
+        for k, v in (logs or {}).items():
+            self.history.setdefault(k, []).append(float(v))
+        self.epoch.assign(epoch + 1)
+
+        if self.every and (epoch + 1) % self.every == 0:
+            self.save()
+
+    # also keep the last epoch of a run that was stopped between checkpoints and mark the run as
+    # finished, a crashed run never gets here
+    def on_train_end(self, logs=None):
+        if int(self.epoch.numpy()) != self.saved_epoch:
+            self.save()
+        os.makedirs(self.path, exist_ok=True)
+        open(os.path.join(self.path, 'finished'), 'w').close()
+
+    # write the history and the checkpoint of the completed epochs, the history is replaced atomically
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'history.json.tmp'), 'w') as f:
+            json.dump(self.history, f)
+        os.replace(os.path.join(self.path, 'history.json.tmp'), os.path.join(self.path, 'history.json'))
+        self.saved_epoch = int(self.epoch.numpy())
+        self.manager.save(checkpoint_number=self.saved_epoch)
@@ -0,0 +1,70 @@
+# import packages
+import cirq
+import sympy
+
+#######################
+# compile the circuits of the quantum layers before they are simulated
+#
+# the layers append their gates one at a time, the compiled circuit has the same expectation
+# values with fewer gates and moments:
+# - gates that are the identity are dropped, these are powers with a constant exponent that is a
+#   multiple of 2 and gates whose exponent only depends on symbols that are known to be zero
+# - diagonal gates (ZPow and CZPow, e.g. the deposits onto the ancillas) are moved back past every
+#   gate they commute with until they join the run of diagonal gates before them
+# - the gates are repacked into moments, each gate in the earliest moment its qubits allow
+# the statevector simulators apply every run of diagonal gates as a single phase
+
+# powers of these gates are the identity for even exponents
+power_gates = (cirq.XPowGate, cirq.ZPowGate, cirq.CXPowGate, cirq.CZPowGate)
+
+# return the qubits an operation acts diagonally on, all qubits of a diagonal gate and the control
+# of a controlled gate
+def diagonal_qubits(op):
+    if isinstance(op.gate, (cirq.ZPowGate, cirq.CZPowGate)):
+        return set(op.qubits)
+    if isinstance(op.gate, cirq.CXPowGate):
+        return {op.qubits[0]}
+    return set()
+
+def is_diagonal(op):
+    return isinstance(op.gate, (cirq.ZPowGate, cirq.CZPowGate))
+
+# a diagonal gate commutes with every operation that is diagonal on the qubits they share
+def commutes_with_diagonal(op, diagonal_op):
+    return set(op.qubits) & set(diagonal_op.qubits) <= diagonal_qubits(op)
+
+def is_identity(op, zero_symbols):
+    if not isinstance(op.gate, power_gates):
+        return False
+    exponent = op.gate.exponent
+    if cirq.is_parameterized(exponent):
+        exponent = exponent.subs({symbol: 0 for symbol in zero_symbols})
+        if cirq.is_parameterized(exponent):
+            return False
+    return abs(float(exponent)/2 - round(float(exponent)/2)) < 1e-9
+
+# return the compiled circuit, zero_symbols are parameters whose values are known to be zero
+# the quantum layers compile without them since their kernels are trained, gates whose learned
+# exponents end up at an identity are only dropped by export.py once the trained values are bound
+def compile_circuit(circuit, zero_symbols=()):
+    zero_symbols = [sympy.Symbol(str(symbol)) for symbol in zero_symbols]
+    operations = []
+    for op in circuit.all_operations():
+        if is_identity(op, zero_symbols):
+            continue
+
+        # move a diagonal gate back while it commutes with the gate before it, it stops behind
+        # another diagonal gate so runs stay together
+        position = len(operations)
+        if is_diagonal(op):
+            while position > 0 and not is_diagonal(operations[position - 1]) and commutes_with_diagonal(operations[position - 1], op):
+                position -= 1
+            if position > 0 and not is_diagonal(operations[position - 1]):
+                position = len(operations)
+        operations.insert(position, op)
+
+    return cirq.Circuit(operations, strategy=cirq.InsertStrategy.EARLIEST)
+
+# number of gates and moments of a circuit
+def circuit_size(circuit):
+    return len(list(circuit.all_operations())), len(cirq.Circuit(circuit.all_operations()))
@@ -1,18 +1,29 @@
 # import packages
 import tensorflow as tf
-import tensorflow_quantum as tfq
 from tensorflow.keras import layers
 import cirq
 import sympy
 import numpy as np
-from utils import normalize_tensor_by_index
+from utils import normalize_tensor_by_index, normalize_channels, extract_patches
+from simulators import get_simulator
+from expectation_cache import Expectation_cache
+from circuit_compiler import compile_circuit
+
+# the activation of a layer can be given as a name, a function or an Activation layer,
+# return it in the serialized form the layer configs store
+def serialize_activation(activation_layer):
+    activation = activation_layer.activation
+    if isinstance(activation, tf.keras.layers.Activation):
+        activation = activation.activation
+    return tf.keras.activations.serialize(activation)
 
 #######################
 # define a keras layer class to contain the quantum convolutional layer
+@tf.keras.utils.register_keras_serializable(package='qcnn')
 class U1_circuit(tf.keras.layers.Layer):
 
     # initialize class
-    def __init__(self, n_kernels, n_input_channels, datatype, registers=1, rdpa=1, inter_U=False, activation=None, name=None, kernel_regularizer=None, **kwargs):
+    def __init__(self, n_kernels, n_input_channels, datatype, registers=1, rdpa=1, inter_U=False, activation=None, name=None, kernel_regularizer=None, fused_kernels=False, backend='tfq', backend_options=None, devices=None, cache_size=None, cache_decimals=4, normalization='batch', channel_stats=None, **kwargs):
         super(U1_circuit, self).__init__(name=name, **kwargs)
         self.n_kernels = n_kernels
         self.n_input_channels = n_input_channels
@@ -20,11 +31,54 @@ class U1_circuit(tf.keras.layers.Layer):
         self.rdpa = rdpa
         self.ancilla = int(registers/rdpa)
         self.datatype = datatype
+        self.normalizes_inputs = True
         self.inter_U = inter_U
         self.learning_params = []
         self.Q_circuit()
         self.activation = tf.keras.layers.Activation(activation)
-        self.kernel_regularizer = kernel_regularizer
+        self.kernel_regularizer = tf.keras.regularizers.get(kernel_regularizer)
+        self.fused_kernels = fused_kernels
+        self.backend = backend
+        self.backend_options = backend_options
+        self.devices = devices
+        self.cache_size = cache_size
+        self.cache_decimals = cache_decimals
+
+        # normalization of the input channels, 'batch' uses the statistics of the whole batch,
+        # 'sample' the statistics of each image and 'pipeline' expects normalized inputs
+        self.normalization = normalization
+
+        # per channel [minimum, maximum] of the training data the 'pipeline' inputs were normalized
+        # with, set by train.py so inference normalizes the same way, None for per sample statistics
+        self.channel_stats = channel_stats
+
+        # stage timer set by profiling.Profiling, the stages of call are only marked while profiling
+        self.profiler = None
+
+        # classical surrogate of the trained kernels set by surrogate.fit_surrogate, used outside of training
+        self.surrogate = None
+
+    # return the arguments the layer was created with, so models can be saved and reloaded
+    def get_config(self):
+        config = super(U1_circuit, self).get_config()
+        config.update({
+            "n_kernels": self.n_kernels,
+            "n_input_channels": self.n_input_channels,
+            "datatype": self.datatype,
+            "registers": self.registers,
+            "rdpa": self.rdpa,
+            "inter_U": self.inter_U,
+            "activation": serialize_activation(self.activation),
+            "kernel_regularizer": tf.keras.regularizers.serialize(self.kernel_regularizer) if self.kernel_regularizer else None,
+            "fused_kernels": self.fused_kernels,
+            "backend": self.backend,
+            "backend_options": self.backend_options,
+            "devices": self.devices,
+            "cache_size": self.cache_size,
+            "cache_decimals": self.cache_decimals,
+            "normalization": self.normalization,
+            "channel_stats": self.channel_stats})
+        return config
 
     # define function to return a new learnable parameter, save all parameters
     def get_new_param(self):
@@ -136,6 +190,7 @@ class U1_circuit(tf.keras.layers.Layer):
         print("Circuit Depth: "+str(len(cirq.Circuit(self.circuit.all_operations()))))
 
         # create list of embedding and learnable parameters
+        self.input_params = input_params
         self.params = input_params + self.learning_params
 
         # perform measurements on first qubit
@@ -156,90 +211,88 @@ class U1_circuit(tf.keras.layers.Layer):
                                       initializer=tf.keras.initializers.glorot_normal(seed=42),
                                       regularizer=self.kernel_regularizer)
 
-        # create circuit tensor containing values for each convolution step
-        self.circuit_tensor = tfq.convert_to_tensor([self.circuit] * self.num_x * self.num_y)
-    # define a function to return a tensor of expectation values for each stride
-    def get_expectations(self, input_data, controller, circuit_batch):
-
-
-        input_data = tf.concat([input_data, controller], 1)
+        # compile the circuit, the compiled circuit is the one that is simulated. no kernel value is
+        # known to be zero while training, so no zero_symbols are passed
+        self.compiled_circuit = compile_circuit(self.circuit)
 
-        # get expectation value for each data point for each batch for a kernel
-        output = tfq.layers.Expectation()(circuit_batch,
-                                               symbol_names=self.params,
-                                               symbol_values=input_data,
-                                               operators=self.measurement)
+        # create the simulator that evaluates the circuit for a batch of data and kernel values
+        self.simulator = get_simulator(self.backend, self.compiled_circuit, self.input_params, self.learning_params, self.measurement, self.backend_options, self.devices)
 
+        # cache the expectation values of repeated patches outside of training
+        self.cache = Expectation_cache(self.simulator, self.cache_size, self.cache_decimals) if self.cache_size else None
+    # define a function to return a tensor of expectation values for each stride
+    # input_data has shape [batch_size*n_strides, n_input_channels*filter_size*filter_size]
+    # and controller has shape [n_kernels, 1, n_learning_params]
+    def get_expectations(self, input_data, controller, training=None):
+
+        # get expectation value for each data point for each batch for each kernel
+        if self.surrogate is not None and not training:
+            output = self.surrogate(input_data[None], tf.transpose(controller, perm=[1, 0, 2]))
+        elif self.cache is not None and not training:
+            output = self.cache(input_data[None], tf.transpose(controller, perm=[1, 0, 2]), self.kernel)
+        else:
+            output = self.simulator(input_data[None], tf.transpose(controller, perm=[1, 0, 2]))
+
+        # reshape to [n_kernels*batch_size, num_x, num_y]
         output = tf.reshape(output, shape=[-1, self.num_x, self.num_y])
         return output
     # define keras backend function to stride kernel and collect data
-    def call(self, inputs):
+    def call(self, inputs, training=None):
+        if self.profiler is not None:
+            inputs = self.profiler.mark(inputs, "start", training, samples=tf.shape(inputs)[0])
         
         
-        inputs = normalize_tensor_by_index(inputs,self.datatype)   
+        if self.normalization == "batch":
+            inputs = normalize_tensor_by_index(inputs,self.datatype)
+        elif self.normalization == "sample":
+            inputs = normalize_channels(inputs,self.datatype)
         
 
-        stack_set = None
-
-        # stride and collect data from input image
-        for i in range(self.num_x):
-            for j in range(self.num_y):
-
-                # collecting image data superimposed with kernel
-
-                slice_part = tf.slice(inputs, [0, i, j, 0], [-1, 2, 2, -1])
-
-                # reshape to [batch_size, n_strides, filter_size, filter_size, n_input_channels]
-                slice_part = tf.reshape(slice_part, shape=[-1, 1, 2, 2, self.n_input_channels])
-
-                # if this is first stride, define new variable
-                if stack_set == None:
-                    stack_set = slice_part
-
-                # if not first stride, concatenate to data from past strides
-                else:
-                    stack_set = tf.concat([stack_set, slice_part], 1)
-
-        # permute shape to [batch_size, n_strides,  n_input_channels, filter_size, filter_size]
-        stack_set = tf.transpose(stack_set, perm=[0, 1, 4, 2, 3])
+        # stride and collect data from input image, shape [batch_size, num_x, num_y, n_input_channels, filter_size*filter_size]
+        stack_set = extract_patches(inputs)
 
         # reshape to [batch_size*n_strides,n_input_channels*filter_size*filter_size]
-
         stack_set = tf.reshape(stack_set, shape=[-1, self.n_input_channels*(2**2)])
+        if self.profiler is not None:
+            stack_set = self.profiler.mark(stack_set, "patches", training)
 
-        # create new tensor by tiling circuit values for each data point in batch
-        circuit_batch = tf.tile([self.circuit_tensor], [tf.shape(inputs)[0], 1])
-
-        # flatten circuit tensor
-        circuit_batch = tf.reshape(circuit_batch, shape=[-1])
+        if self.fused_kernels or (self.surrogate is not None and not training):
 
-        # initialize list to hold expectation values
-        outputs = []
-        for i in range(self.n_kernels):
+            # evaluate all kernels in a single simulator call, the surrogate evaluates all kernels at once
+            output_tensor = self.get_expectations(stack_set, self.kernel, training)
 
-            # create new tensor by tiling kernel values for each stride for each
+            # reshape to [batch_size, num_x, num_y, n_kernels]
+            output_tensor = tf.reshape(output_tensor, shape=[self.n_kernels, -1, self.num_x, self.num_y])
+            output_tensor = tf.transpose(output_tensor, perm=[1, 2, 3, 0])
+        else:
+            # initialize list to hold expectation values
+            outputs = []
+            for i in range(self.n_kernels):
 
-            controller = tf.tile(self.kernel[i], [tf.shape(inputs)[0]*self.num_x*self.num_y, 1])
+                # append to a list the expectations for all input data in the batch
+                outputs.append(self.get_expectations(stack_set, self.kernel[i:i+1], training))
 
-            # append to a list the expectations for all input data in the batch,
+            # stack the expectation values for each kernel
+            output_tensor = tf.stack(outputs, axis=3)
 
-            outputs.append(self.get_expectations(stack_set, controller, circuit_batch))
-
-        # stack the expectation values for each kernel
-
-        output_tensor = tf.stack(outputs, axis=3)
+        if self.profiler is not None:
+            output_tensor = self.profiler.mark(output_tensor, "simulation", training, circuits=tf.shape(stack_set)[0]*self.n_kernels)
 
         # if values are less than -1 or greater than 1, make -1 or 1, respectively
         output_tensor = tf.math.acos(tf.clip_by_value(output_tensor, -1+1e-5, 1-1e-5)) / np.pi
 
         # return the activated tensor of expectation values
-        return self.activation(output_tensor)
+        output_tensor = self.activation(output_tensor)
+        if self.profiler is not None:
+            output_tensor = self.profiler.mark(output_tensor, "postprocessing", training)
+        return output_tensor
 
 ####U1 MODIFIED CIRCUIT WITH MORE PHASE ENTANGLEMENT BETWEEN THE ANCILLARY QUBIT AND THE THE REST OF THE PIXEL QUBITS####
+@tf.keras.utils.register_keras_serializable(package='qcnn')
 class U1_Modified_circuit(tf.keras.layers.Layer):
 
     # initialize class
-    def __init__(self, n_kernels, n_input_channels, datatype, registers=1, rdpa=1, inter_U=False, activation=None, name=None, kernel_regularizer=None, **kwargs):
+    def __init__(self, n_kernels, n_input_channels, datatype, registers=1, rdpa=1, inter_U=False, activation=None, name=None, kernel_regularizer=None, fused_kernels=False, backend='tfq', backend_options=None, devices=None, cache_size=None, cache_decimals=4, normalization='batch', channel_stats=None, **kwargs):
         super(U1_Modified_circuit, self).__init__(name=name, **kwargs)
         self.n_kernels = n_kernels
         self.n_input_channels = n_input_channels
@@ -247,11 +300,54 @@ class U1_Modified_circuit(tf.keras.layers.Layer):
         self.rdpa = rdpa
         self.ancilla = int(registers/rdpa)
         self.datatype = datatype
+        self.normalizes_inputs = True
         self.inter_U = inter_U
         self.learning_params = []
         self.Q_circuit()
         self.activation = tf.keras.layers.Activation(activation)
-        self.kernel_regularizer = kernel_regularizer
+        self.kernel_regularizer = tf.keras.regularizers.get(kernel_regularizer)
+        self.fused_kernels = fused_kernels
+        self.backend = backend
+        self.backend_options = backend_options
+        self.devices = devices
+        self.cache_size = cache_size
+        self.cache_decimals = cache_decimals
+
+        # normalization of the input channels, 'batch' uses the statistics of the whole batch,
+        # 'sample' the statistics of each image and 'pipeline' expects normalized inputs
+        self.normalization = normalization
+
+        # per channel [minimum, maximum] of the training data the 'pipeline' inputs were normalized
+        # with, set by train.py so inference normalizes the same way, None for per sample statistics
+        self.channel_stats = channel_stats
+
+        # stage timer set by profiling.Profiling, the stages of call are only marked while profiling
+        self.profiler = None
+
+        # classical surrogate of the trained kernels set by surrogate.fit_surrogate, used outside of training
+        self.surrogate = None
+
+    # return the arguments the layer was created with, so models can be saved and reloaded
+    def get_config(self):
+        config = super(U1_Modified_circuit, self).get_config()
+        config.update({
+            "n_kernels": self.n_kernels,
+            "n_input_channels": self.n_input_channels,
+            "datatype": self.datatype,
+            "registers": self.registers,
+            "rdpa": self.rdpa,
+            "inter_U": self.inter_U,
+            "activation": serialize_activation(self.activation),
+            "kernel_regularizer": tf.keras.regularizers.serialize(self.kernel_regularizer) if self.kernel_regularizer else None,
+            "fused_kernels": self.fused_kernels,
+            "backend": self.backend,
+            "backend_options": self.backend_options,
+            "devices": self.devices,
+            "cache_size": self.cache_size,
+            "cache_decimals": self.cache_decimals,
+            "normalization": self.normalization,
+            "channel_stats": self.channel_stats})
+        return config
 
     # define function to return a new learnable parameter, save all parameters
     # in self.learning_params
@@ -368,6 +464,7 @@ class U1_Modified_circuit(tf.keras.layers.Layer):
         print("Circuit Depth: "+str(len(cirq.Circuit(self.circuit.all_operations()))))
 
         # create list of embedding and learnable parameters
+        self.input_params = input_params
         self.params = input_params + self.learning_params
 
         # perform measurements on first qubit
@@ -388,87 +485,137 @@ class U1_Modified_circuit(tf.keras.layers.Layer):
                                       initializer=tf.keras.initializers.glorot_normal(seed=42),
                                       regularizer=self.kernel_regularizer)
 
-        # create circuit tensor containing values for each convolution step
-        self.circuit_tensor = tfq.convert_to_tensor([self.circuit] * self.num_x * self.num_y)
-    # define a function to return a tensor of expectation values for each stride
-    def get_expectations(self, input_data, controller, circuit_batch):
-
-        input_data = tf.concat([input_data, controller], 1)
+        # compile the circuit, the compiled circuit is the one that is simulated. no kernel value is
+        # known to be zero while training, so no zero_symbols are passed
+        self.compiled_circuit = compile_circuit(self.circuit)
 
-        # get expectation value for each data point for each batch for a kernel
-        output = tfq.layers.Expectation()(circuit_batch,
-                                               symbol_names=self.params,
-                                               symbol_values=input_data,
-                                               operators=self.measurement)
+        # create the simulator that evaluates the circuit for a batch of data and kernel values
+        self.simulator = get_simulator(self.backend, self.compiled_circuit, self.input_params, self.learning_params, self.measurement, self.backend_options, self.devices)
 
+        # cache the expectation values of repeated patches outside of training
+        self.cache = Expectation_cache(self.simulator, self.cache_size, self.cache_decimals) if self.cache_size else None
+    # define a function to return a tensor of expectation values for each stride
+    # input_data has shape [batch_size*n_strides, n_input_channels*filter_size*filter_size]
+    # and controller has shape [n_kernels, 1, n_learning_params]
+    def get_expectations(self, input_data, controller, training=None):
+
+        # get expectation value for each data point for each batch for each kernel
+        if self.surrogate is not None and not training:
+            output = self.surrogate(input_data[None], tf.transpose(controller, perm=[1, 0, 2]))
+        elif self.cache is not None and not training:
+            output = self.cache(input_data[None], tf.transpose(controller, perm=[1, 0, 2]), self.kernel)
+        else:
+            output = self.simulator(input_data[None], tf.transpose(controller, perm=[1, 0, 2]))
+
+        # reshape to [n_kernels*batch_size, num_x, num_y]
         output = tf.reshape(output, shape=[-1, self.num_x, self.num_y])
         return output
     # define keras backend function to stride kernel and collect data
-    def call(self, inputs):
+    def call(self, inputs, training=None):
+        if self.profiler is not None:
+            inputs = self.profiler.mark(inputs, "start", training, samples=tf.shape(inputs)[0])
         
         
-        inputs = normalize_tensor_by_index(inputs,self.datatype)   
+        if self.normalization == "batch":
+            inputs = normalize_tensor_by_index(inputs,self.datatype)
+        elif self.normalization == "sample":
+            inputs = normalize_channels(inputs,self.datatype)
         
-        # define dummy variable to check if we are collecting data for first step
-        stack_set = None
-
-        # stride and collect data from input image
-        for i in range(self.num_x):
-            for j in range(self.num_y):
-
-                # collecting image data superimposed with kernel
-                slice_part = tf.slice(inputs, [0, i, j, 0], [-1, 2, 2, -1])
-
-                # reshape to [batch_size, n_strides, filter_size, filter_size, n_input_channels]
-                slice_part = tf.reshape(slice_part, shape=[-1, 1, 2, 2, self.n_input_channels])
 
-                if stack_set == None:
-                    stack_set = slice_part
-
-                # if not first stride, concatenate to data from past strides
-                else:
-                    stack_set = tf.concat([stack_set, slice_part], 1)
-
-        # permute shape to [batch_size, n_strides,  n_input_channels, filter_size, filter_size]
-        stack_set = tf.transpose(stack_set, perm=[0, 1, 4, 2, 3])
+        # stride and collect data from input image, shape [batch_size, num_x, num_y, n_input_channels, filter_size*filter_size]
+        stack_set = extract_patches(inputs)
 
         # reshape to [batch_size*n_strides,n_input_channels*filter_size*filter_size]
         stack_set = tf.reshape(stack_set, shape=[-1, self.n_input_channels*(2**2)])
+        if self.profiler is not None:
+            stack_set = self.profiler.mark(stack_set, "patches", training)
 
-        # create new tensor by tiling circuit values for each data point in batch
-        circuit_batch = tf.tile([self.circuit_tensor], [tf.shape(inputs)[0], 1])
+        if self.fused_kernels or (self.surrogate is not None and not training):
 
-        # flatten circuit tensor
-        circuit_batch = tf.reshape(circuit_batch, shape=[-1])
+            # evaluate all kernels in a single simulator call, the surrogate evaluates all kernels at once
+            output_tensor = self.get_expectations(stack_set, self.kernel, training)
 
-        # initialize list to hold expectation values
-        outputs = []
-        for i in range(self.n_kernels):
+            # reshape to [batch_size, num_x, num_y, n_kernels]
+            output_tensor = tf.reshape(output_tensor, shape=[self.n_kernels, -1, self.num_x, self.num_y])
+            output_tensor = tf.transpose(output_tensor, perm=[1, 2, 3, 0])
+        else:
+            # initialize list to hold expectation values
+            outputs = []
+            for i in range(self.n_kernels):
 
-            controller = tf.tile(self.kernel[i], [tf.shape(inputs)[0]*self.num_x*self.num_y, 1])
+                # append to a list the expectations for all input data in the batch
+                outputs.append(self.get_expectations(stack_set, self.kernel[i:i+1], training))
 
-            outputs.append(self.get_expectations(stack_set, controller, circuit_batch))
+            # stack the expectation values for each kernel
+            output_tensor = tf.stack(outputs, axis=3)
+
+        if self.profiler is not None:
+            output_tensor = self.profiler.mark(output_tensor, "simulation", training, circuits=tf.shape(stack_set)[0]*self.n_kernels)
 
-        # stack the expectation values for each kernel
-        output_tensor = tf.stack(outputs, axis=3)
         # if values are less than -1 or greater than 1, make -1 or 1, respectively
         output_tensor = tf.math.acos(tf.clip_by_value(output_tensor, -1+1e-5, 1-1e-5)) / np.pi
 
         # return the activated tensor of expectation values
-        return self.activation(output_tensor)
+        output_tensor = self.activation(output_tensor)
+        if self.profiler is not None:
+            output_tensor = self.profiler.mark(output_tensor, "postprocessing", training)
+        return output_tensor
 
+@tf.keras.utils.register_keras_serializable(package='qcnn')
 class Q_U1_control(tf.keras.layers.Layer):
 
     # initialize class
-    def __init__(self, n_kernels, datatype, padding=False, classical_weights=False, activation=None, name=None, kernel_regularizer=None, **kwargs):
+    def __init__(self, n_kernels, datatype, padding=False, classical_weights=False, activation=None, name=None, kernel_regularizer=None, fused_kernels=False, backend='tfq', backend_options=None, devices=None, cache_size=None, cache_decimals=4, normalization='batch', channel_stats=None, **kwargs):
         super(Q_U1_control, self).__init__(name=name, **kwargs)
         self.n_kernels = n_kernels
+        self.padding = padding
         self.classical_weights = classical_weights
         self.datatype = datatype
+        self.normalizes_inputs = classical_weights
         self.learning_params = []
         self.Q_circuit()
         self.activation = tf.keras.layers.Activation(activation)
-        self.kernel_regularizer = kernel_regularizer
+        self.kernel_regularizer = tf.keras.regularizers.get(kernel_regularizer)
+        self.fused_kernels = fused_kernels
+        self.backend = backend
+        self.backend_options = backend_options
+        self.devices = devices
+        self.cache_size = cache_size
+        self.cache_decimals = cache_decimals
+
+        # normalization of the input channels, 'batch' uses the statistics of the whole batch,
+        # 'sample' the statistics of each image and 'pipeline' expects normalized inputs
+        self.normalization = normalization
+
+        # per channel [minimum, maximum] of the training data the 'pipeline' inputs were normalized
+        # with, set by train.py so inference normalizes the same way, None for per sample statistics
+        self.channel_stats = channel_stats
+
+        # stage timer set by profiling.Profiling, the stages of call are only marked while profiling
+        self.profiler = None
+
+        # classical surrogate of the trained kernels set by surrogate.fit_surrogate, used outside of training
+        self.surrogate = None
+
+    # return the arguments the layer was created with, so models can be saved and reloaded
+    def get_config(self):
+        config = super(Q_U1_control, self).get_config()
+        config.update({
+            "n_kernels": self.n_kernels,
+            "datatype": self.datatype,
+            "padding": self.padding,
+            "classical_weights": self.classical_weights,
+            "activation": serialize_activation(self.activation),
+            "kernel_regularizer": tf.keras.regularizers.serialize(self.kernel_regularizer) if self.kernel_regularizer else None,
+            "fused_kernels": self.fused_kernels,
+            "backend": self.backend,
+            "backend_options": self.backend_options,
+            "devices": self.devices,
+            "cache_size": self.cache_size,
+            "cache_decimals": self.cache_decimals,
+            "normalization": self.normalization,
+            "channel_stats": self.channel_stats})
+        return config
 
     # define function to return a new learnable parameter, save all parameters
     # in self.learning_params
@@ -514,6 +661,7 @@ class Q_U1_control(tf.keras.layers.Layer):
         print("Circuit Depth: "+str(len(cirq.Circuit(self.circuit.all_operations()))))
 
         # create list of embedding and learnable parameters
+        self.input_params = input_params
         self.params = input_params + self.learning_params
 
         # perform measurements on first qubit
@@ -551,73 +699,79 @@ class Q_U1_control(tf.keras.layers.Layer):
 
 
 
-        # create circuit tensor containing values for each convolution step
-        self.circuit_tensor = tfq.convert_to_tensor([self.circuit] * self.num_x * self.num_y * self.n_input_channels)
+        # compile the circuit, the compiled circuit is the one that is simulated. no kernel value is
+        # known to be zero while training, so no zero_symbols are passed
+        self.compiled_circuit = compile_circuit(self.circuit)
 
-    # define a function to return a tensor of expectation values for each stride
-    def get_expectations(self, input_data, controller, circuit_batch):
+        # create the simulator that evaluates the circuit for a batch of data and kernel values
+        self.simulator = get_simulator(self.backend, self.compiled_circuit, self.input_params, self.learning_params, self.measurement, self.backend_options, self.devices)
 
-        input_data = tf.concat([input_data, controller], 1)
+        # cache the expectation values of repeated patches outside of training
+        self.cache = Expectation_cache(self.simulator, self.cache_size, self.cache_decimals) if self.cache_size else None
 
-        # get expectation value for each data point for each batch for a kernel
-        output = tfq.layers.Expectation()(circuit_batch,
-                                               symbol_names=self.params,
-                                               symbol_values=input_data,
-                                               operators=self.measurement)
-        # reshape tensor of expectation value
-        output = tf.reshape(output, shape=[-1, self.num_x, self.num_y, self.n_input_channels])
+    # define a function to return a tensor of expectation values for each stride
+    # input_data has shape [n_input_channels, batch_size*n_strides, filter_size*filter_size]
+    # and controller has shape [n_kernels, n_input_channels, n_learning_params]
+    def get_expectations(self, input_data, controller, training=None):
+
+        # get expectation value for each data point for each batch for each kernel
+        if self.surrogate is not None and not training:
+            output = self.surrogate(input_data, tf.transpose(controller, perm=[1, 0, 2]))
+        elif self.cache is not None and not training:
+            output = self.cache(input_data, tf.transpose(controller, perm=[1, 0, 2]), self.kernel)
+        else:
+            output = self.simulator(input_data, tf.transpose(controller, perm=[1, 0, 2]))
+
+        # reshape tensor of expectation value to [n_kernels*batch_size, num_x, num_y, n_input_channels]
+        output = tf.reshape(output, shape=[self.n_input_channels, -1, self.num_x, self.num_y])
+        output = tf.transpose(output, perm=[1, 2, 3, 0])
         if self.classical_weights:
             output = tf.math.multiply(output,self.channel_weights)
             output = tf.math.add(output,self.channel_bias)
         return tf.math.reduce_sum(output, 3)
-    def call(self, inputs):
+    def call(self, inputs, training=None):
+        if self.profiler is not None:
+            inputs = self.profiler.mark(inputs, "start", training, samples=tf.shape(inputs)[0])
         
-        if self.classical_weights:
+        if self.classical_weights and self.normalization == "batch":
             inputs = normalize_tensor_by_index(inputs,self.datatype)
-        # define dummy variable to check if we are collecting data for first step
-        stack_set = None
-
-        # stride and collect data from input image
-        for i in range(self.num_x):
-            for j in range(self.num_y):
-
-                slice_part = tf.slice(inputs, [0, i, j, 0], [-1, 2, 2, -1])
-
-                # reshape to [batch_size, n_strides, filter_size, filter_size, n_input_channels]
-                slice_part = tf.reshape(slice_part, shape=[-1, 1, 2, 2, self.n_input_channels])
-
-                if stack_set == None:
-                    stack_set = slice_part
-
-                # if not first stride, concatenate to data from past strides
-                else:
-                    stack_set = tf.concat([stack_set, slice_part], 1)
-
-        # permute shape to [batch_size, n_strides,  n_input_channels, filter_size, filter_size]
-        stack_set = tf.transpose(stack_set, perm=[0, 1, 4, 2, 3])
+        elif self.classical_weights and self.normalization == "sample":
+            inputs = normalize_channels(inputs,self.datatype)
+        # stride and collect data from input image, shape [batch_size, num_x, num_y, n_input_channels, filter_size*filter_size]
+        stack_set = extract_patches(inputs)
 
-        # reshape to [batch_size*n_strides*n_input_channels, filter_size*filter_size]
-        stack_set = tf.reshape(stack_set, shape=[-1, 2**2])
+        # reshape to [n_input_channels, batch_size*n_strides, filter_size*filter_size]
+        stack_set = tf.reshape(tf.transpose(stack_set, perm=[3, 0, 1, 2, 4]), shape=[self.n_input_channels, -1, 2**2])
+        if self.profiler is not None:
+            stack_set = self.profiler.mark(stack_set, "patches", training)
 
-        circuit_batch = tf.tile([self.circuit_tensor], [tf.shape(inputs)[0], 1])
+        if self.fused_kernels or (self.surrogate is not None and not training):
 
-        # flatten circuit tensor
-        circuit_batch = tf.reshape(circuit_batch, shape=[-1])
+            # evaluate all kernels in a single simulator call, the surrogate evaluates all kernels at once
+            output_tensor = self.get_expectations(stack_set, self.kernel, training)
 
+            # reshape to [batch_size, num_x, num_y, n_kernels]
+            output_tensor = tf.reshape(output_tensor, shape=[self.n_kernels, -1, self.num_x, self.num_y])
+            output_tensor = tf.transpose(output_tensor, perm=[1, 2, 3, 0])
+        else:
+            # initialize list to hold expectation values
+            outputs = []
+            for i in range(self.n_kernels):
 
-        # initialize list to hold expectation values
-        outputs = []
-        for i in range(self.n_kernels):
+                # append to a list the expectations for all input data in the batch
+                outputs.append(self.get_expectations(stack_set, self.kernel[i:i+1], training))
 
-            controller = tf.tile(self.kernel[i], [tf.shape(inputs)[0]*self.num_x*self.num_y, 1])
+            # stack the expectation values for each kernel
+            output_tensor = tf.stack(outputs, axis=3)
 
-            # append to a list the expectations for all input data in the batch
-            outputs.append(self.get_expectations(stack_set, controller, circuit_batch))
+        if self.profiler is not None:
+            output_tensor = self.profiler.mark(output_tensor, "simulation", training, circuits=tf.shape(stack_set)[0]*tf.shape(stack_set)[1]*self.n_kernels)
 
-        # stack the expectation values for each kernel
-        output_tensor = tf.stack(outputs, axis=3)
         # if values are less than -1 or greater than 1, make -1 or 1, respectively
         output_tensor = tf.math.acos(tf.clip_by_value(output_tensor, -1+1e-5, 1-1e-5)) / np.pi
 
         # return the activated tensor of expectation values
-        return self.activation(output_tensor)
+        output_tensor = self.activation(output_tensor)
+        if self.profiler is not None:
+            output_tensor = self.profiler.mark(output_tensor, "postprocessing", training)
+        return output_tensor
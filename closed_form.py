@@ -0,0 +1,193 @@
+# import packages
+import os
+import hashlib
+import importlib.util
+import tensorflow as tf
+import cirq
+import sympy
+from sympy.polys.rings import ring
+from sympy.printing.tensorflow import tensorflow_code
+
+# directory that holds the generated expectation functions
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'closed_form_cache')
+
+# pauli operators are stored as integers
+I, X, Y, Z = 0, 1, 2, 3
+
+# product table of single qubit paulis, (a, b) -> (phase, a*b)
+pauli_products = {}
+for a in range(4):
+    pauli_products[(I, a)] = (1, a)
+    pauli_products[(a, I)] = (1, a)
+    pauli_products[(a, a)] = (1, I)
+for a, b, c in [(X, Y, Z), (Y, Z, X), (Z, X, Y)]:
+    pauli_products[(a, b)] = (1j, c)
+    pauli_products[(b, a)] = (-1j, c)
+
+# multiply two pauli strings, returns the phase and the resulting string
+def multiply_paulis(p, q):
+    phase = 1
+    result = []
+    for a, b in zip(p, q):
+        factor, c = pauli_products[(a, b)]
+        phase = phase*factor
+        result.append(c)
+    return phase, tuple(result)
+
+def paulis_commute(p, q):
+    return sum(1 for a, b in zip(p, q) if a != I and b != I and a != b) % 2 == 0
+
+# decompose an operation into commuting pauli rotations exp(-i*angle/2*P), up to global phase
+# returns a list of (pauli string, angle) or None for the hadamard gate
+def get_rotations(op, qubits):
+    gate = op.gate
+    index = [qubits.index(q) for q in op.qubits]
+
+    # build a pauli string acting on the given qubits
+    def pauli(*pairs):
+        string = [I]*len(qubits)
+        for q, p in pairs:
+            string[q] = p
+        return tuple(string)
+
+    if isinstance(gate, cirq.CXPowGate):
+        t = gate.exponent
+        c, target = index
+        return [(pauli((c, Z)), sympy.pi*t/2), (pauli((target, X)), sympy.pi*t/2), (pauli((c, Z), (target, X)), -sympy.pi*t/2)]
+    if isinstance(gate, cirq.CZPowGate):
+        t = gate.exponent
+        c, target = index
+        return [(pauli((c, Z)), sympy.pi*t/2), (pauli((target, Z)), sympy.pi*t/2), (pauli((c, Z), (target, Z)), -sympy.pi*t/2)]
+    if isinstance(gate, cirq.XPowGate):
+        return [(pauli((index[0], X)), sympy.pi*gate.exponent)]
+    if isinstance(gate, cirq.ZPowGate):
+        return [(pauli((index[0], Z)), sympy.pi*gate.exponent)]
+    if isinstance(gate, cirq.HPowGate) and gate.exponent == 1:
+        return None
+    raise ValueError("Gate "+str(op)+" is not supported by the closed form compiler")
+
+#######################
+# derive the expectation value of a pauli measurement symbolically
+#
+# the measured observable is propagated backwards through the circuit (Heisenberg picture)
+# as a sum of pauli strings with polynomial coefficients in the cosines and sines of the
+# rotation angles, then evaluated on |0...0>
+def derive_expectation(circuit, measurement, max_terms=4096):
+    qubits = sorted(circuit.all_qubits())
+    operations = list(circuit.all_operations())
+    rotations = [get_rotations(op, qubits) for op in operations]
+
+    # define a cosine and sine generator for every distinct angle
+    angles = []
+    for gate_rotations in rotations:
+        for _, angle in gate_rotations or []:
+            if angle not in angles:
+                angles.append(angle)
+    names = ['c%d' % i for i in range(len(angles))] + ['s%d' % i for i in range(len(angles))]
+    polynomials, *generators = ring(names, sympy.QQ)
+    cosines = dict(zip(angles, generators[:len(angles)]))
+    sines = dict(zip(angles, generators[len(angles):]))
+
+    # initialize the observable
+    pauli_string = cirq.PauliString(measurement)
+    observable = [I]*len(qubits)
+    for q, p in pauli_string.items():
+        observable[qubits.index(q)] = {'X': X, 'Y': Y, 'Z': Z}[str(p)]
+    terms = {tuple(observable): polynomials(1)}
+
+    # conjugate the observable with every gate in reverse order
+    for op, gate_rotations in reversed(list(zip(operations, rotations))):
+
+        # the hadamard gate maps X <-> Z and Y -> -Y
+        if gate_rotations is None:
+            q = qubits.index(op.qubits[0])
+            new_terms = {}
+            for string, coefficient in terms.items():
+                string = list(string)
+                if string[q] == Y:
+                    coefficient = -coefficient
+                string[q] = {I: I, X: Z, Y: Y, Z: X}[string[q]]
+                new_terms[tuple(string)] = new_terms.get(tuple(string), 0) + coefficient
+            terms = new_terms
+            continue
+
+        # exp(i*a/2*P) Q exp(-i*a/2*P) = cos(a) Q - i sin(a) QP for anticommuting P, Q
+        for rotation, angle in gate_rotations:
+            new_terms = {}
+            for string, coefficient in terms.items():
+                if paulis_commute(string, rotation):
+                    new_terms[string] = new_terms.get(string, 0) + coefficient
+                    continue
+                new_terms[string] = new_terms.get(string, 0) + coefficient*cosines[angle]
+                phase, product = multiply_paulis(string, rotation)
+                sign = int((-1j*phase).real)
+                new_terms[product] = new_terms.get(product, 0) + sign*coefficient*sines[angle]
+            terms = {string: coefficient for string, coefficient in new_terms.items() if coefficient != 0}
+            if len(terms) > max_terms:
+                raise ValueError("Closed form expectation exceeds "+str(max_terms)+" pauli terms, use the statevector backend for this circuit")
+
+    # only strings of I and Z survive on |0...0>
+    expectation = polynomials(0)
+    for string, coefficient in terms.items():
+        if all(p in (I, Z) for p in string):
+            expectation = expectation + coefficient
+
+    # reduce with cos^2 + sin^2 = 1 and substitute the trigonometric functions
+    expectation = expectation.rem([sines[a]**2 + cosines[a]**2 - 1 for a in angles])
+    expression = expectation.as_expr()
+    substitutions = {}
+    for a in angles:
+        substitutions[sympy.Symbol(str(cosines[a]))] = sympy.cos(a)
+        substitutions[sympy.Symbol(str(sines[a]))] = sympy.sin(a)
+    return expression.subs(substitutions) * float(pauli_string.coefficient.real)
+
+# write the expression as a vectorized tensorflow function
+def generate_code(expression, symbols):
+    arguments = ", ".join(str(s) for s in symbols)
+    code = "# generated by closed_form.py, do not edit\n"
+    code += "import tensorflow\n\n"
+    code += "expression = " + repr(str(expression)) + "\n\n"
+    code += "def expectation(" + arguments + "):\n"
+    code += "    return " + tensorflow_code(expression) + "\n"
+    return code
+
+# derive, generate and cache the expectation function of a circuit
+def load_expectation_function(circuit, measurement, symbols):
+    key = hashlib.sha256((repr(circuit) + repr(measurement) + repr([str(s) for s in symbols])).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, 'expectation_' + key + '.py')
+
+    if not os.path.exists(path):
+        expression = derive_expectation(circuit, measurement)
+        print("Closed Form Expectation: " + str(expression))
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(generate_code(expression, symbols))
+        os.replace(path + '.tmp', path)
+
+    spec = importlib.util.spec_from_file_location('expectation_' + key, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.expectation
+
+#######################
+# evaluate the circuit with its closed form expectation, see simulators.py for the interface
+class Closed_form_simulator:
+
+    # initialize class
+    def __init__(self, circuit, input_params, learning_params, measurement):
+        self.n_input_params = len(input_params)
+        self.n_learning_params = len(learning_params)
+        self.function = load_expectation_function(circuit, measurement, list(input_params) + list(learning_params))
+
+    def __call__(self, input_data, controller):
+        input_data = tf.cast(input_data, tf.float32)
+        controller = tf.cast(controller, tf.float32)
+
+        # every symbol is passed as a tensor broadcastable to [n_groups, n_kernels, n_rows]
+        arguments = [input_data[:, None, :, i] for i in range(self.n_input_params)]
+        arguments += [controller[:, :, None, i] for i in range(self.n_learning_params)]
+        output = tf.cast(self.function(*arguments), tf.float32)
+
+        # keep every kernel value connected so parameters that drop out get zero gradients
+        output = output + 0.0*tf.reduce_sum(controller, axis=2, keepdims=True)
+        return tf.broadcast_to(output, [tf.shape(input_data)[0], tf.shape(controller)[1], tf.shape(input_data)[1]])
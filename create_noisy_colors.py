@@ -1,54 +1,81 @@
 # Import the necessary libraries
-import random
-from PIL import Image
-from numpy import asarray
-import numpy as np 
+import argparse
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+import numpy as np
 
-# the directory where the base colors are stored
+# the directories where the base colors are stored
 paths = ['./mixed_colors/','./mixed_colors_shapes/']
 
-for path in paths:
-# get file names only
-    colors = [ f for f in os.listdir(path) if os.path.isfile(os.path.join(path,f))]
-    print(colors)
-    os.mkdir(path+"noisy_colors/")
-    for i in range(len(colors)):
+# number of images generated by one task of the process pool
+chunk_size = 1000
 
-# create the one hot encoded folders
-      os.mkdir(path+"noisy_colors/"+str(i))
+# load the base color images of a directory, sorted by file name
+def load_base_colors(path):
+    colors = sorted(f for f in os.listdir(path) if os.path.isfile(os.path.join(path,f)) and f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')))
+    images = [np.asarray(Image.open(path+c).convert('RGB')).copy() for c in colors]
+    return [os.path.splitext(c)[0] for c in colors], images
 
-# load the image and convert into numpy array
-      numpydata_pure = np.asarray(Image.open(path+colors[i]).convert('RGB')).copy()
+# corrupt noise_percent of the pixels of n copies of a base image to black
+# the pixels are drawn without replacement among the pixels that are not black already
+def add_noise(base, n, noise_percent, rng):
+    height, width, _ = base.shape
+    candidates = np.flatnonzero(base.reshape(-1, 3).any(axis=1))
+    noise_pixels = min(int(noise_percent*height*width), len(candidates))
 
-# percent of pixels to corrupt to black
-      noise_percent = 0.2
-      noise_pixels = int(noise_percent*(len(numpydata_pure[0]))**2)
+    # the first noise_pixels entries of a random permutation of the candidates of every image
+    order = np.argpartition(rng.random((n, len(candidates))), noise_pixels - 1, axis=1)[:, :noise_pixels] if noise_pixels else np.zeros((n, 0), dtype=int)
+    images = np.repeat(base.reshape(1, -1, 3), n, axis=0)
+    images[np.arange(n)[:, None], candidates[order]] = 0
+    return images.reshape(n, height, width, 3)
 
-# number of total images to create
-      N = 400
-      print(colors[i])
+# generate one chunk of images of a base color and write them as png files or into the shard
+# every chunk has its own seed so the output does not depend on the number of workers
+def generate_chunk(task):
+    path, label, base, start, n, noise_percent, seed, output, offset = task
+    rng = np.random.default_rng([seed, label, start])
+    images = add_noise(base, n, noise_percent, rng)
 
-      for j in range(N):
+    if output == "png":
+        for j in range(n):
+            Image.fromarray(images[j], 'RGB').save(path+"noisy_colors/"+str(label)+"/"+str(start+j)+".png")
+    else:
+        shard = np.load(path+"noisy_colors.npy", mmap_mode='r+')
+        shard[offset+start:offset+start+n] = images
+        shard.flush()
+    return n
 
-        numpydata = numpydata_pure.copy()
-        k = 0
-        while k < noise_pixels:
+def create_noisy_colors(path, N=400, noise_percent=0.2, seed=0, output="png", workers=None):
+    colors, bases = load_base_colors(path)
+    print(colors)
 
-# find a random pixel
-          rand_h = random.randint(0,len(numpydata[0])-1)
-          rand_w = random.randint(0,len(numpydata[0])-1)
+    # create the one hot encoded folders or the shard with its labels and class names
+    if output == "png":
+        for i in range(len(colors)):
+            os.makedirs(path+"noisy_colors/"+str(i), exist_ok=True)
+    else:
+        height, width, _ = bases[0].shape
+        np.lib.format.open_memmap(path+"noisy_colors.npy", mode='w+', dtype=np.uint8, shape=(len(colors)*N, height, width, 3)).flush()
+        np.save(path+"noisy_colors_labels.npy", np.repeat(np.arange(len(colors), dtype=np.int32), N))
+        with open(path+"noisy_colors_classes.json", 'w') as f:
+            json.dump(colors, f)
 
-# check to see if pixel is already black, if not then blacken
-          if numpydata[rand_h][rand_w][0] == 0 and numpydata[rand_h][rand_w][1] == 0 and numpydata[rand_h][rand_w][2] == 0:
-            pass
+    tasks = [(path, i, bases[i], start, min(chunk_size, N - start), noise_percent, seed, output, i*N)
+             for i in range(len(colors)) for start in range(0, N, chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        print(str(sum(pool.map(generate_chunk, tasks)))+" images written to "+path+"noisy_colors"+(".npy" if output == "npy" else "/"))
 
-          else:
-            numpydata[rand_h][rand_w][0] = 0.0
-            numpydata[rand_h][rand_w][1] = 0.0
-            numpydata[rand_h][rand_w][2] = 0.0
-            k = k + 1
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the noisy color datasets from the base colors in "+", ".join(paths))
+    parser.add_argument("--N", type=int, default=400, help="number of images per base color")
+    parser.add_argument("--noise-percent", type=float, default=0.2, help="fraction of pixels corrupted to black")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", choices=["png", "npy"], default="png", help="one png per image or a single .npy shard with a label array")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of cpus)")
+    parser.add_argument("--paths", nargs="+", default=paths)
+    args = parser.parse_args()
 
-#convert the array back to an image and save
-        img_noise = Image.fromarray(numpydata, 'RGB')
-        img_noise = img_noise.save(path+"noisy_colors/"+str(i)+"/"+str(j)+".png")
+    for path in args.paths:
+        create_noisy_colors(path, args.N, args.noise_percent, args.seed, args.output, args.workers)
@@ -0,0 +1,228 @@
+# import packages
+import argparse
+import json
+import os
+import cirq
+import numpy as np
+import tensorflow as tf
+
+# import project functions, importing serve imports circuits which registers the quantum layers
+from serve import load_predict_function
+from circuits import serialize_activation
+from simulators import Statevector_simulator
+from circuit_compiler import compile_circuit, is_diagonal, power_gates
+from utils import normalized_datatypes
+import inference
+
+#######################
+# export a trained model as a compact inference artifact
+#
+# the kernels of a trained quantum layer are fixed, so the learned exponents are bound into the
+# circuits and every kernel (and every channel of Q_U1_control) gets its own pruned circuit:
+# - bound exponents within tolerance of an even integer are dropped as identities and those within
+#   tolerance of an odd integer are snapped to it, which makes them Clifford gates
+# - adjacent pairs of the same Clifford gate cancel
+# - gates outside the backward light cone of the measured qubit never change the expectation value
+#   and are dropped, as are diagonal gates at the end of a circuit that measures Z
+# the pruned circuits are written with the weights of the dense head and the normalization of the
+# inputs to a single .npz file, which inference.py loads and runs with numpy alone
+
+# whether a gate is a Clifford power, the simulators ignore global phases so every odd power of a
+# power gate is the same gate
+def is_clifford(op):
+    if isinstance(op.gate, cirq.HPowGate):
+        return op.gate.exponent == 1
+    return isinstance(op.gate, power_gates) and not cirq.is_parameterized(op.gate.exponent) and float(op.gate.exponent) % 2 == 1
+
+# bind the kernel values of a circuit and drop or snap the exponents close to integers
+def bind_circuit(circuit, learning_params, values, tolerance, stats):
+    circuit = cirq.resolve_parameters(circuit, {symbol: float(value) for symbol, value in zip(learning_params, values)})
+    operations = []
+    for op in circuit.all_operations():
+        if isinstance(op.gate, power_gates) and not cirq.is_parameterized(op.gate.exponent):
+            exponent = float(op.gate.exponent)
+            nearest = round(exponent)
+            if abs(exponent - nearest) < tolerance:
+                if nearest % 2 == 0:
+                    stats["identity"] += 1
+                    continue
+                if exponent != nearest:
+                    stats["snapped"] += 1
+                    op = type(op.gate)(exponent=1, global_shift=op.gate.global_shift).on(*op.qubits)
+        operations.append(op)
+    return cirq.Circuit(operations)
+
+# remove adjacent pairs of the same Clifford gate, no other gate acts on their qubits in between
+def cancel_pairs(operations, stats):
+    kept = []
+    last = {}
+    for op in operations:
+        previous = [last.get(q) for q in op.qubits]
+        if previous[0] is not None and all(p == previous[0] for p in previous):
+            other = kept[previous[0]]
+            if (is_clifford(op) and is_clifford(other) and type(op.gate) == type(other.gate)
+                    and (op.qubits == other.qubits or (is_diagonal(op) and set(op.qubits) == set(other.qubits)))):
+                kept[previous[0]] = None
+                for q in op.qubits:
+                    last.pop(q)
+                stats["cancelled"] += 2
+                continue
+        last.update({q: len(kept) for q in op.qubits})
+        kept.append(op)
+    kept = [op for op in kept if op is not None]
+
+    # a removed pair can uncover another pair, repeat until nothing changes
+    if len(kept) < len(operations):
+        return cancel_pairs(kept, stats)
+    return kept
+
+# keep the operations in the backward light cone of the measured qubits
+def light_cone(operations, measurement, stats):
+    relevant = set(measurement.qubits)
+    diagonal_observable = all(pauli == cirq.Z for pauli in cirq.PauliString(measurement).values())
+    kept = []
+    for op in reversed(operations):
+        if not set(op.qubits) & relevant or (diagonal_observable and is_diagonal(op)):
+            stats["light_cone"] += 1
+            continue
+        kept.append(op)
+        relevant |= set(op.qubits)
+        if not is_diagonal(op):
+            diagonal_observable = False
+    return kept[::-1]
+
+# parses a pruned circuit into rows of [gate, qubit, qubit, input index, coefficient, offset], the
+# measured qubits are simulated even if every gate on them was pruned
+class Circuit_parser(Statevector_simulator):
+
+    # the gates are written unfused, inference.py fuses the diagonal runs itself
+    fuse_diagonal = False
+
+    # initialize class
+    def __init__(self, circuit, input_params, measurement):
+        self.measured_qubits = set(measurement.qubits)
+        super().__init__(circuit, input_params, [], measurement)
+
+    def order_qubits(self, circuit):
+        return sorted(set(circuit.all_qubits()) | self.measured_qubits)
+
+    def rows(self):
+        rows = np.zeros([len(self.operations), 6])
+        for i, (kind, qubits, exponent) in enumerate(self.operations):
+            if isinstance(exponent, float):
+                exponent = (None, -1, 0.0, exponent)
+            rows[i] = [inference.gates.index(kind), qubits[0], qubits[1] if len(qubits) > 1 else -1, exponent[1], exponent[2], exponent[3]]
+        return rows
+
+    def describe(self):
+        coefficient, paulis = self.observable
+        return {"n_qubits": self.n_qubits, "coefficient": [coefficient.real, coefficient.imag], "paulis": paulis}
+
+# the pruned circuit of one kernel of a layer, group is the channel of Q_U1_control
+def prune_circuit(layer, kernel, group, tolerance, stats):
+    circuit = bind_circuit(layer.compiled_circuit, layer.learning_params, kernel[group], tolerance, stats)
+    operations = list(compile_circuit(circuit).all_operations())
+    operations = light_cone(cancel_pairs(operations, stats), layer.measurement, stats)
+    return Circuit_parser(cirq.Circuit(operations), layer.input_params, layer.measurement)
+
+# return the metadata and the arrays of the layers after the quantum layer
+def export_head(layers, arrays):
+    head = []
+    for layer in layers:
+        if isinstance(layer, tf.keras.layers.Flatten):
+            head.append({"type": "flatten"})
+        elif isinstance(layer, tf.keras.layers.Dropout):
+            continue
+        elif isinstance(layer, (tf.keras.layers.Dense, tf.keras.layers.Activation)):
+            activation = tf.keras.activations.serialize(layer.activation)
+            if activation not in inference.activations:
+                raise ValueError("Activation "+str(activation)+" of "+layer.name+" is not supported, choose from "+str(list(inference.activations)))
+            if isinstance(layer, tf.keras.layers.Activation):
+                head.append({"type": "activation", "activation": activation})
+                continue
+            name = "dense_"+str(len(head))
+            arrays[name+"_kernel"] = layer.kernel.numpy()
+            arrays[name+"_bias"] = layer.bias.numpy() if layer.use_bias else np.zeros(layer.units, dtype=np.float32)
+            head.append({"type": "dense", "activation": activation, "kernel": name+"_kernel", "bias": name+"_bias"})
+        else:
+            raise ValueError("Layer "+layer.name+" of type "+type(layer).__name__+" cannot be exported")
+    return head
+
+# export a saved model to path, returns the metadata of the artifact
+def export_model(model_path, path, tolerance=1e-3, n_validation=32, seed=0):
+    model, predict = load_predict_function(model_path)
+    layers = [layer for layer in model.layers if not isinstance(layer, tf.keras.layers.InputLayer)]
+    layer = layers[0]
+    if not hasattr(layer, 'compiled_circuit'):
+        raise ValueError("The first layer of "+model.name+" must be a quantum layer, got "+type(layer).__name__)
+    activation = serialize_activation(layer)
+    if activation not in inference.activations:
+        raise ValueError("Activation "+str(activation)+" of "+layer.name+" is not supported, choose from "+str(list(inference.activations)))
+
+    # the inputs of the exported model are normalized like the inputs of the served model
+    normalization = "none"
+    arrays = {}
+    if layer.normalizes_inputs and layer.datatype in normalized_datatypes:
+        normalization = "batch" if layer.normalization == "batch" else "sample"
+        if layer.normalization == "pipeline" and layer.channel_stats is not None:
+            normalization = "dataset"
+            arrays["channel_min"], arrays["channel_max"] = [np.asarray(v, dtype=np.float32) for v in layer.channel_stats]
+
+    # a circuit for every kernel of every group
+    stats = {"identity": 0, "snapped": 0, "cancelled": 0, "light_cone": 0}
+    kernel = layer.kernel.numpy()
+    circuits = []
+    for k in range(kernel.shape[0]):
+        for g in range(kernel.shape[1]):
+            parser = prune_circuit(layer, kernel[k], g, tolerance, stats)
+            name = "circuit_"+str(k)+"_"+str(g)
+            arrays[name] = parser.rows()
+            circuits.append(dict(parser.describe(), name=name, kernel=k, group=g))
+
+    weighted = getattr(layer, 'classical_weights', False)
+    if weighted:
+        arrays["channel_w"] = layer.channel_weights.numpy()
+        arrays["channel_b"] = layer.channel_bias.numpy()
+
+    gates_before = len(list(layer.compiled_circuit.all_operations()))*len(circuits)
+    metadata = {"format": 1,
+                "model": model.name,
+                "layer": type(layer).__name__,
+                "input_shape": list(model.input_shape[1:]),
+                "datatype": layer.datatype,
+                "normalization": normalization,
+                "grouping": "channel" if kernel.shape[1] > 1 else "none",
+                "n_kernels": int(kernel.shape[0]),
+                "n_groups": int(kernel.shape[1]),
+                "classical_weights": bool(weighted),
+                "activation": activation,
+                "circuits": circuits,
+                "head": export_head(layers[1:], arrays),
+                "pruning": dict(stats, tolerance=tolerance, gates_before=gates_before, gates_after=sum(len(arrays[c["name"]]) for c in circuits))}
+
+    # compare the artifact with the model on random images
+    if n_validation:
+        x = np.random.default_rng(seed).random((n_validation,) + tuple(model.input_shape[1:]), dtype=np.float32)
+        compact = inference.Compact_model(metadata, arrays)
+        difference = np.abs(compact.predict(x) - predict(x).numpy())
+        metadata["validation"] = {"samples": n_validation, "max_abs_error": float(difference.max()), "mean_abs_error": float(difference.mean())}
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.savez_compressed(path, metadata=np.array(json.dumps(metadata)), **arrays)
+    return metadata
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a trained model as a compact artifact that runs with numpy alone.")
+    parser.add_argument("model", help="model saved by train.py, e.g. output/<time>_<model>/model.keras")
+    parser.add_argument("--output", help="artifact file (default model_compact.npz next to the model)")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="exponents this close to an integer are dropped or snapped")
+    parser.add_argument("--validate", type=int, default=32, help="random images the artifact is compared with the model on, 0 to skip")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(os.path.dirname(args.model), 'model_compact.npz')
+    metadata = export_model(args.model, output, args.tolerance, args.validate)
+    pruning = metadata["pruning"]
+    print("Exported "+str(len(metadata["circuits"]))+" circuits to "+output+": "+str(pruning["gates_before"])+" -> "+str(pruning["gates_after"])+" gates ("+
+          ", ".join(k+" "+str(pruning[k]) for k in ["identity", "snapped", "cancelled", "light_cone"])+")")
+    if "validation" in metadata:
+        print("Validation on "+str(metadata["validation"]["samples"])+" images: max error "+str(metadata["validation"]["max_abs_error"])+", mean error "+str(metadata["validation"]["mean_abs_error"]))
@@ -0,0 +1,68 @@
+# import packages
+import os
+import hashlib
+import tensorflow as tf
+import numpy as np
+
+# directory that holds the stored quantum layer outputs
+store_dir = 'feature_store'
+
+#######################
+# train the classical head of a model on stored outputs of its frozen quantum layer
+#
+# the quantum layer is evaluated once per dataset and set of weights, its outputs are written to
+# a memory-mapped .npy file named after the normalization of the layer, a hash of the data and a
+# hash of the layer weights, so the head can be trained for many epochs (or retrained with other
+# settings) without simulating
+
+# return the quantum layer of a model and a model of the layers after it, the head shares its
+# layers with the full model so training the head also trains the full model
+def split_model(model):
+    index = [i for i, layer in enumerate(model.layers) if hasattr(layer, 'simulator')][0]
+    quantum_layer = model.layers[index]
+
+    head_input = tf.keras.layers.Input(quantum_layer.output_shape[1:], name='features')
+    x = head_input
+    for layer in model.layers[index + 1:]:
+        x = layer(x)
+    return quantum_layer, tf.keras.models.Model(inputs=head_input, outputs=x, name=model.name+'_head')
+
+def hash_array(array):
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()[:16]
+
+def hash_weights(layer):
+    digest = hashlib.sha1(layer.name.encode())
+    for weight in layer.get_weights():
+        digest.update(np.ascontiguousarray(weight).tobytes())
+    return digest.hexdigest()[:16]
+
+# return the outputs of the quantum layer for x, computing and storing them if necessary. the
+# file name also covers the normalization of the layer, with 'batch' the outputs depend on the
+# statistics of every batch and so on the batch size
+def get_features(quantum_layer, x, batch_size=50):
+    x = np.asarray(x, dtype=np.float32)
+    normalization = quantum_layer.normalization + (str(batch_size) if quantum_layer.normalization == 'batch' else '')
+    path = os.path.join(store_dir, quantum_layer.name+'_'+normalization+'_'+hash_array(x)+'_'+hash_weights(quantum_layer)+'.npy')
+
+    if not os.path.exists(path):
+        print("Computing quantum features for "+str(len(x))+" samples: "+path)
+        os.makedirs(store_dir, exist_ok=True)
+        output_shape = quantum_layer.compute_output_shape((None,) + x.shape[1:])[1:]
+        features = np.lib.format.open_memmap(path+'.tmp', mode='w+', dtype=np.float32, shape=(len(x),) + tuple(output_shape))
+        evaluate = tf.function(lambda batch: quantum_layer(batch, training=False))
+        for i in range(0, len(x), batch_size):
+            features[i:i+batch_size] = evaluate(x[i:i+batch_size]).numpy()
+        features.flush()
+        del features
+        os.replace(path+'.tmp', path)
+
+    return np.load(path, mmap_mode='r')
+
+# freeze the quantum layer of the model and return its head together with the stored
+# train and test features
+def prepare_head(model, x_train, x_test, batch_size=50):
+    quantum_layer, head = split_model(model)
+    quantum_layer.trainable = False
+    train_features = get_features(quantum_layer, x_train, batch_size)
+    test_features = get_features(quantum_layer, x_test, batch_size)
+    return head, train_features, test_features
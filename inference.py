@@ -0,0 +1,231 @@
+# import packages, the artifacts run with numpy alone
+import argparse
+import json
+import numpy as np
+
+#######################
+# run a model exported by export.py without tensorflow, cirq or sympy
+#
+# the artifact holds a pruned circuit for every kernel (and every channel of Q_U1_control) as rows
+# of [gate, qubit, qubit, input index, coefficient, offset], an exponent is coefficient*input +
+# offset or the constant offset if the input index is -1. the runs of gates that do not depend on
+# the data are multiplied into one unitary per run when the artifact is loaded, so a patch only
+# needs its data encodings and one matrix product per run. the expectation values go through the
+# same post processing as in the quantum layers and then through the dense head
+
+# gate codes of the circuit rows
+gates = ["H", "X", "Z", "CX", "CZ"]
+
+# circuits with more qubits apply their constant gates one by one instead of as a unitary
+max_unitary_qubits = 10
+
+def softmax(x):
+    x = np.exp(x - x.max(axis=-1, keepdims=True))
+    return x / x.sum(axis=-1, keepdims=True)
+
+activations = {"linear": lambda x: x,
+               "relu": lambda x: np.maximum(x, 0),
+               "sigmoid": lambda x: 1/(1 + np.exp(-x)),
+               "tanh": np.tanh,
+               "softmax": softmax}
+
+# same as utils.scale_channels
+def scale_channels(x, minimum, maximum):
+    n_channels = x.shape[-1]
+    extent = maximum - minimum
+    return ((x - minimum) / np.where(extent > 0, extent, 1) + np.arange(n_channels)) / n_channels
+
+# same as utils.extract_patches, returns [batch_size, num_x, num_y, n_input_channels, 4]
+def extract_patches(x):
+    num_x, num_y = x.shape[1] - 1, x.shape[2] - 1
+    return np.stack([x[:, i:i+num_x, j:j+num_y, :] for i in range(2) for j in range(2)], axis=-1)
+
+#############################
+# matrix entries of the gates with zero global shift, t is a number or an array with one value per row
+def x_pow(t):
+    phase = np.exp(1j*np.pi*t/2)
+    return phase*np.cos(np.pi*t/2), -1j*phase*np.sin(np.pi*t/2), -1j*phase*np.sin(np.pi*t/2), phase*np.cos(np.pi*t/2)
+
+def z_pow(t):
+    return 1, 0, 0, np.exp(1j*np.pi*t)
+
+# a circuit of an artifact, the state has shape [n_rows, 2, ..., 2]
+class Compact_circuit:
+
+    # initialize class
+    def __init__(self, rows, n_qubits, coefficient, paulis):
+        self.n_qubits = n_qubits
+        self.coefficient = complex(*coefficient)
+        self.paulis = paulis
+        operations = [(gates[int(row[0])], [int(q) for q in row[1:3] if q >= 0], (int(row[3]), row[4], row[5])) for row in rows]
+        self.steps = self.plan(operations)
+
+    # group the operations into constant unitaries, fused runs of diagonal gates and single gates
+    def plan(self, operations):
+        steps = []
+        constant = []
+        for operation in operations:
+            data = operation[2][0] >= 0
+            if not data and self.n_qubits <= max_unitary_qubits:
+                constant.append(operation)
+                continue
+            if constant:
+                steps.append(("UNITARY", self.unitary(constant)))
+                constant = []
+            if operation[0] in ("Z", "CZ"):
+                if steps and steps[-1][0] == "DIAG":
+                    steps[-1][1].append(self.diagonal_term(operation))
+                else:
+                    steps.append(("DIAG", [self.diagonal_term(operation)]))
+            else:
+                steps.append(operation)
+        if constant:
+            steps.append(("UNITARY", self.unitary(constant)))
+        return steps
+
+    # the basis states a diagonal gate adds its exponent to the phase of, with its exponent
+    def diagonal_term(self, operation):
+        mask = np.zeros([2 if q in operation[1] else 1 for q in range(self.n_qubits)])
+        mask[tuple(1 if q in operation[1] else 0 for q in range(self.n_qubits))] = 1
+        return mask, operation[2]
+
+    # the unitary of a run of constant operations, applied to every basis state
+    def unitary(self, operations):
+        dimension = 2**self.n_qubits
+        state = np.eye(dimension, dtype=np.complex128).reshape([dimension] + [2]*self.n_qubits)
+        state = self.apply(state, operations, None)
+        return state.reshape(dimension, dimension).T
+
+    def exponent(self, exponent, x):
+        index, coefficient, offset = exponent
+        if index < 0:
+            return offset
+        return coefficient*x[:, index] + offset
+
+    # reshape a per-row value so it broadcasts against a state of the given rank
+    def expand(self, value, rank):
+        value = np.asarray(value)
+        return value.reshape(value.shape + (1,)*(rank - value.ndim)) if value.ndim else value
+
+    def apply_single(self, state, axis, matrix):
+        m00, m01, m10, m11 = [self.expand(m, state.ndim - 1) for m in matrix]
+        s0, s1 = np.take(state, 0, axis=axis), np.take(state, 1, axis=axis)
+        return np.stack([m00*s0 + m01*s1, m10*s0 + m11*s1], axis=axis)
+
+    def apply_controlled(self, state, control_axis, target_axis, matrix):
+        s0, s1 = np.take(state, 0, axis=control_axis), np.take(state, 1, axis=control_axis)
+        s1 = self.apply_single(s1, target_axis - 1 if target_axis > control_axis else target_axis, matrix)
+        return np.stack([s0, s1], axis=control_axis)
+
+    def apply(self, state, operations, x):
+        for kind, qubits, exponent in operations:
+            axes = [q + 1 for q in qubits]
+            if kind == "H":
+                state = self.apply_single(state, axes[0], (1/np.sqrt(2), 1/np.sqrt(2), 1/np.sqrt(2), -1/np.sqrt(2)))
+                continue
+            t = self.exponent(exponent, x)
+            if kind == "X":
+                state = self.apply_single(state, axes[0], x_pow(t))
+            elif kind == "Z":
+                state = self.apply_single(state, axes[0], z_pow(t))
+            elif kind == "CX":
+                state = self.apply_controlled(state, axes[0], axes[1], x_pow(t))
+            elif kind == "CZ":
+                state = self.apply_controlled(state, axes[0], axes[1], z_pow(t))
+        return state
+
+    # expectation values for input rows x of shape [n_rows, n_inputs]
+    def __call__(self, x):
+        state = np.zeros([len(x)] + [2]*self.n_qubits, dtype=np.complex128)
+        state[(slice(None),) + (0,)*self.n_qubits] = 1
+        for step in self.steps:
+            if step[0] == "UNITARY":
+                state = (state.reshape(len(x), -1) @ step[1].T).reshape(state.shape)
+            elif step[0] == "DIAG":
+                phase = sum(self.expand(self.exponent(exponent, x), self.n_qubits + 1)*mask[None] for mask, exponent in step[1])
+                state = state*np.exp(1j*np.pi*phase)
+            else:
+                state = self.apply(state, [step], x)
+
+        pauli_state = state
+        for qubit, pauli in self.paulis:
+            s0, s1 = np.take(pauli_state, 0, axis=qubit + 1), np.take(pauli_state, 1, axis=qubit + 1)
+            if pauli == "X":
+                s0, s1 = s1, s0
+            elif pauli == "Y":
+                s0, s1 = -1j*s1, 1j*s0
+            elif pauli == "Z":
+                s1 = -s1
+            pauli_state = np.stack([s0, s1], axis=qubit + 1)
+        return np.real(self.coefficient*np.sum(np.conj(state)*pauli_state, axis=tuple(range(1, self.n_qubits + 1))))
+
+#############################
+# a model exported by export.py
+class Compact_model:
+
+    # initialize class with the metadata and arrays of an artifact
+    def __init__(self, metadata, arrays):
+        self.metadata = metadata
+        self.arrays = arrays
+        self.circuits = {(c["kernel"], c["group"]): Compact_circuit(arrays[c["name"]], c["n_qubits"], c["coefficient"], c["paulis"]) for c in metadata["circuits"]}
+
+    def normalize(self, x):
+        if self.metadata["normalization"] == "dataset":
+            return scale_channels(x, self.arrays["channel_min"], self.arrays["channel_max"])
+        if self.metadata["normalization"] == "sample":
+            return scale_channels(x, x.min(axis=(1, 2), keepdims=True), x.max(axis=(1, 2), keepdims=True))
+        if self.metadata["normalization"] == "batch":
+            return scale_channels(x, x.min(axis=(0, 1, 2)), x.max(axis=(0, 1, 2)))
+        return x
+
+    # the output of the quantum layer, [batch_size, num_x, num_y, n_kernels]
+    def quantum_layer(self, x):
+        patches = extract_patches(self.normalize(x))
+        batch_size, num_x, num_y, n_input_channels = patches.shape[:4]
+        outputs = []
+        for k in range(self.metadata["n_kernels"]):
+            if self.metadata["grouping"] == "channel":
+                # every channel has its own circuit, the channels are weighted and summed
+                output = np.stack([self.circuits[k, c](patches[:, :, :, c].reshape(-1, 4)).reshape(batch_size, num_x, num_y) for c in range(n_input_channels)], axis=-1)
+                if self.metadata["classical_weights"]:
+                    output = output*self.arrays["channel_w"] + self.arrays["channel_b"]
+                outputs.append(output.sum(axis=-1))
+            else:
+                outputs.append(self.circuits[k, 0](patches.reshape(-1, n_input_channels*4)).reshape(batch_size, num_x, num_y))
+        output = np.arccos(np.clip(np.stack(outputs, axis=-1), -1+1e-5, 1-1e-5)) / np.pi
+        return activations[self.metadata["activation"]](output)
+
+    # predict a batch of images [batch_size, height, width, channels]
+    def predict(self, x):
+        x = self.quantum_layer(np.asarray(x, dtype=np.float64))
+        for layer in self.metadata["head"]:
+            if layer["type"] == "flatten":
+                x = x.reshape(len(x), -1)
+            elif layer["type"] == "dense":
+                x = activations[layer["activation"]](x @ self.arrays[layer["kernel"]] + self.arrays[layer["bias"]])
+            elif layer["type"] == "activation":
+                x = activations[layer["activation"]](x)
+        return x.astype(np.float32)
+
+# load an artifact written by export.py
+def load_artifact(path):
+    with np.load(path, allow_pickle=False) as data:
+        metadata = json.loads(str(data["metadata"]))
+        arrays = {k: data[k] for k in data.files if k != "metadata"}
+    if metadata.get("format") != 1:
+        raise ValueError("Unknown artifact format "+str(metadata.get("format")))
+    return Compact_model(metadata, arrays)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predict a batch of images with an artifact written by export.py.")
+    parser.add_argument("artifact", help="artifact file, e.g. output/<time>_<model>/model_compact.npz")
+    parser.add_argument("images", help=".npy file with a batch of images [batch_size, height, width, channels]")
+    parser.add_argument("--output", help="write the class probabilities to this .npy file instead of printing the classes")
+    args = parser.parse_args()
+
+    model = load_artifact(args.artifact)
+    predictions = model.predict(np.load(args.images, allow_pickle=False))
+    if args.output:
+        np.save(args.output, predictions)
+    else:
+        print(predictions.argmax(axis=-1))
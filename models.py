@@ -8,7 +8,8 @@ from tensorflow.keras import datasets, layers, models
 from circuits import U1_circuit, Q_U1_control, U1_Modified_circuit
 ###########################
 # build quantum convolutional neural network
-def CO_U1_QCNN_model(datatype,classes):
+# channels is the number of input channels of the CHANNELS dataset, the other datasets have 3
+def CO_U1_QCNN_model(datatype,classes,resize_x=10,resize_y=10,backend='tfq',devices=None,cache_size=None,normalization='batch',fused_kernels=False,backend_options=None,channels=12):
 
     def plot_circuit(circuit, save_path="circuit_diagram.svg"):
         """
@@ -23,17 +24,17 @@ def CO_U1_QCNN_model(datatype,classes):
             print(f"Circuit diagram saved to: {save_path}")
 
     if datatype == "CHANNELS":
-        x_input = tf.keras.layers.Input((10,10,12), name = 'input')
+        x_input = tf.keras.layers.Input((resize_x,resize_y,channels), name = 'input')
 
-        x_qconv1 = U1_circuit(n_kernels=3, n_input_channels=12,activation='relu', datatype=datatype,
+        x_qconv1 = U1_circuit(n_kernels=3, n_input_channels=channels,activation='relu', datatype=datatype, backend=backend, devices=devices, cache_size=cache_size, normalization=normalization, fused_kernels=fused_kernels, backend_options=backend_options,
                       name='CO_U1_QCNN')(x_input)
 
     if datatype == "COLORS" or datatype == "CIFAR10" or datatype == "COLORS_SHAPE":
-        x_input = tf.keras.layers.Input((10,10,3), name = 'input')
+        x_input = tf.keras.layers.Input((resize_x,resize_y,3), name = 'input')
 
         # Create an instance of U1_circuit
         u1_circuit_layer = U1_circuit(n_kernels=3, n_input_channels=3, activation='relu',
-                                      datatype=datatype, name='CO_U1_QCNN')
+                                      datatype=datatype, backend=backend, devices=devices, cache_size=cache_size, normalization=normalization, fused_kernels=fused_kernels, backend_options=backend_options, name='CO_U1_QCNN')
 
         # Print the circuit before applying the layer to the input
         print("Quantum Circuit:")
@@ -61,7 +62,7 @@ def CO_U1_QCNN_model(datatype,classes):
 
 ###########################
 # build quantum convolutional neural network
-def MODIFIED_CO_U1_QCNN_model(datatype,classes):
+def MODIFIED_CO_U1_QCNN_model(datatype,classes,resize_x=10,resize_y=10,backend='tfq',devices=None,cache_size=None,normalization='batch',fused_kernels=False,backend_options=None,channels=12):
     def plot_circuit(circuit, save_path="circuit_diagram.svg"):
         """
         Visualizes and saves a quantum circuit as an SVG file.
@@ -75,17 +76,17 @@ def MODIFIED_CO_U1_QCNN_model(datatype,classes):
             print(f"Circuit diagram saved to: {save_path}")
 
     if datatype == "CHANNELS":
-        x_input = tf.keras.layers.Input((10,10,12), name = 'input')
+        x_input = tf.keras.layers.Input((resize_x,resize_y,channels), name = 'input')
 
-        x_qconv1 = U1_Modified_circuit(n_kernels=3, n_input_channels=12,activation='relu', datatype=datatype,
+        x_qconv1 = U1_Modified_circuit(n_kernels=3, n_input_channels=channels,activation='relu', datatype=datatype, backend=backend, devices=devices, cache_size=cache_size, normalization=normalization, fused_kernels=fused_kernels, backend_options=backend_options,
                       name='MODIFIED_CO_U1_QCNN')(x_input)
 
     if datatype == "COLORS" or datatype == "CIFAR10" or datatype == "COLORS_SHAPE":
-        x_input = tf.keras.layers.Input((10,10,3), name = 'input')
+        x_input = tf.keras.layers.Input((resize_x,resize_y,3), name = 'input')
 
         # Create an instance of U1_circuit
         u1_circuit_layer = U1_Modified_circuit(n_kernels=3, n_input_channels=3, activation='relu',
-                                      datatype=datatype, name='MODIFIED_CO_U1_QCNN')
+                                      datatype=datatype, backend=backend, devices=devices, cache_size=cache_size, normalization=normalization, fused_kernels=fused_kernels, backend_options=backend_options, name='MODIFIED_CO_U1_QCNN')
 
         # Print the circuit before applying the layer to the input
         print("Quantum Circuit:")
@@ -112,20 +113,20 @@ def MODIFIED_CO_U1_QCNN_model(datatype,classes):
     return tf.keras.models.Model(inputs = x_input, outputs = x_fc2, name = 'MODIFIED_CO_U1_QCNN')
 
 ############################
-def QCNN_U1_control_model(datatype,classes):
+def QCNN_U1_control_model(datatype,classes,resize_x=10,resize_y=10,backend='tfq',devices=None,cache_size=None,normalization='batch',fused_kernels=False,backend_options=None,channels=12):
 
     if datatype=="CHANNELS":
-        x_input = tf.keras.layers.Input((10,10,12), name = 'input')
+        x_input = tf.keras.layers.Input((resize_x,resize_y,channels), name = 'input')
     
     if datatype=="COLORS" or datatype == "CIFAR10" or datatype == "COLORS_SHAPE":
-        x_input = tf.keras.layers.Input((10,10,3), name = 'input')
+        x_input = tf.keras.layers.Input((resize_x,resize_y,3), name = 'input')
     
-    x_qconv1 = Q_U1_control(n_kernels=3, activation=tf.keras.layers.Activation('relu'),datatype=datatype,
+    x_qconv1 = Q_U1_control(n_kernels=3, activation=tf.keras.layers.Activation('relu'),datatype=datatype, backend=backend, devices=devices, cache_size=cache_size, normalization=normalization, fused_kernels=fused_kernels, backend_options=backend_options,
                       name='Control_U1_QCNN')(x_input)
 
     x_flatten = tf.keras.layers.Flatten()(x_qconv1)
 
-    x_fc1 = tf.keras.layers.Dense(32, activation=tf.keras.layers.Activation('relu'))(x_flatten)
+    x_fc1 = tf.keras.layers.Dense(32, activation='relu')(x_flatten)
 
     if datatype == "COLORS":
         x_fc2 = tf.keras.layers.Dense(9, activation='softmax')(x_fc1)
@@ -138,20 +139,20 @@ def QCNN_U1_control_model(datatype,classes):
 
     return tf.keras.models.Model(inputs = x_input, outputs = x_fc2, name = 'Control_U1_QCNN')
 ############################
-def QCNN_U1_weighted_control_model(datatype,classes):
+def QCNN_U1_weighted_control_model(datatype,classes,resize_x=10,resize_y=10,backend='tfq',devices=None,cache_size=None,normalization='batch',fused_kernels=False,backend_options=None,channels=12):
 
     if datatype=="CHANNELS":
-        x_input = tf.keras.layers.Input((10,10,12), name = 'input')
+        x_input = tf.keras.layers.Input((resize_x,resize_y,channels), name = 'input')
     
     if datatype=="COLORS" or datatype == "CIFAR10" or datatype == "COLORS_SHAPE":
-        x_input = tf.keras.layers.Input((10,10,3), name = 'input')
+        x_input = tf.keras.layers.Input((resize_x,resize_y,3), name = 'input')
     
-    x_qconv1 = Q_U1_control(n_kernels=3, classical_weights=True, activation=tf.keras.layers.Activation('relu'),datatype=datatype,
+    x_qconv1 = Q_U1_control(n_kernels=3, classical_weights=True, activation=tf.keras.layers.Activation('relu'),datatype=datatype, backend=backend, devices=devices, cache_size=cache_size, normalization=normalization, fused_kernels=fused_kernels, backend_options=backend_options,
                       name='WEV_U1_QCNN')(x_input)
 
     x_flatten = tf.keras.layers.Flatten()(x_qconv1)
 
-    x_fc1 = tf.keras.layers.Dense(32, activation=tf.keras.layers.Activation('relu'))(x_flatten)
+    x_fc1 = tf.keras.layers.Dense(32, activation='relu')(x_flatten)
 
     if datatype == "COLORS":
         x_fc2 = tf.keras.layers.Dense(9, activation='softmax')(x_fc1)
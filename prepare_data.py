@@ -1,11 +1,14 @@
 # import packages
+import os
+import shutil
+import json
+import hashlib
 import tensorflow as tf
-from sklearn.utils import shuffle
 import numpy as np
-from tqdm import tqdm
 
-def datasize(datatype,num_of_classes):
+def datasize(datatype,num_of_classes,samples=None):
     #Train/test split is 5:1 for CIFAR-10 and 4:1 for colors
+    #samples sets the training samples of the generated CHANNELS data, the test split is a fifth of it
     if datatype == "COLORS":
         train_size = 2880
         test_size = 720
@@ -15,8 +18,8 @@ def datasize(datatype,num_of_classes):
         test_size = 1920
 
     if datatype == "CHANNELS":
-        train_size = 1000
-        test_size = 200
+        train_size = samples or 1000
+        test_size = train_size//5
 
     if datatype == "CIFAR10":
         train_size = num_of_classes*500
@@ -24,7 +27,206 @@ def datasize(datatype,num_of_classes):
     
     return train_size, test_size
 
-def build_model_datasets(datatype,details,num_of_classes):
+# draw class balanced, disjoint index sets from labels
+# split_sizes holds the number of images per class of each split, either an int or a list with a
+# quota for every class in class_indicies, e.g. [400, 100] for a stratified 400/100 per class split
+# returns one shuffled index array per split
+def balanced_split(labels, class_indicies, split_sizes, seed=None):
+    labels = np.asarray(labels).flatten()
+    rng = np.random.default_rng(seed)
+    quotas = [np.broadcast_to(size, [len(class_indicies)]) for size in split_sizes]
+
+    splits = [[] for _ in split_sizes]
+    for c, class_index in enumerate(class_indicies):
+        candidates = rng.permutation(np.flatnonzero(labels == class_index))
+        needed = sum(int(quota[c]) for quota in quotas)
+        if needed > len(candidates):
+            raise ValueError("Class "+str(class_index)+" has "+str(len(candidates))+" images but "+str(needed)+" were requested")
+        start = 0
+        for split, quota in zip(splits, quotas):
+            split.append(candidates[start:start+int(quota[c])])
+            start += int(quota[c])
+
+    return [rng.permutation(np.concatenate(split)) for split in splits]
+
+# directory that holds the preprocessed datasets
+cache_dir = 'dataset_cache'
+
+# directories of the synthetic datasets created by create_noisy_colors.py
+data_dirs = {"COLORS": './mixed_colors/noisy_colors',
+             "COLORS_SHAPE": './mixed_colors_shapes/noisy_colors'}
+
+# load the images, labels and class names of a synthetic dataset written as a single .npy shard
+# by create_noisy_colors.py --output npy, returns None if there is no shard
+def load_shard(datatype):
+    data_dir = data_dirs[datatype]
+    if not os.path.exists(data_dir+'.npy'):
+        return None
+    with open(data_dir+'_classes.json') as f:
+        classes = json.load(f)
+    return np.load(data_dir+'.npy', mmap_mode='r'), np.load(data_dir+'_labels.npy'), classes
+
+# stratified 4:1 train/test split of the samples of every class
+def stratified_split(labels, n_classes, seed=None):
+    counts = np.bincount(labels, minlength=n_classes)
+    return balanced_split(labels, range(n_classes), [(counts*4)//5, counts - (counts*4)//5], seed)
+
+# hash the names, sizes and modification times of the files of a dataset directory and its shard
+def hash_directory(data_dir):
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(data_dir)):
+        for name in sorted(files):
+            info = os.stat(os.path.join(root, name))
+            digest.update((os.path.relpath(os.path.join(root, name), data_dir)+str(info.st_size)+str(info.st_mtime_ns)).encode())
+    for suffix in ['.npy', '_labels.npy', '_classes.json']:
+        if os.path.exists(data_dir+suffix):
+            info = os.stat(data_dir+suffix)
+            digest.update((suffix+str(info.st_size)+str(info.st_mtime_ns)).encode())
+    return digest.hexdigest()
+
+# return the cache directory of a dataset, the key covers everything the preprocessed splits
+# depend on including the contents of the source directory for the synthetic datasets
+def dataset_cache_path(datatype,details,num_of_classes,seed,channels=12,samples=None):
+    key = {"datatype": datatype, "classes": num_of_classes, "resize": [details[1], details[2]],
+           "sizes": list(datasize(datatype,num_of_classes,samples)), "seed": seed}
+    if datatype == "CHANNELS":
+        key["channels"] = channels
+    if datatype in data_dirs:
+        # the train/test split of the synthetic datasets is made in batches
+        key["batch_size"] = details[4]
+        key["source"] = hash_directory(data_dirs[datatype])
+    name = datatype+'_'+str(num_of_classes)+'_'+str(details[1])+'x'+str(details[2])+'_'+str(seed)
+    return os.path.join(cache_dir, name+'_'+hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:12])
+
+# return x_train, x_test, y_train, y_test, classes for a dataset, the splits are loaded memory
+# mapped from the dataset cache and only preprocessed if they are not cached yet
+def build_model_datasets(datatype,details,num_of_classes,seed=42,channels=12,samples=None):
+    path = dataset_cache_path(datatype,details,num_of_classes,seed,channels,samples)
+    names = ['x_train', 'x_test', 'y_train', 'y_test']
+
+    if not os.path.exists(path):
+        splits = preprocess_datasets(datatype,details,num_of_classes,seed,channels,samples)
+        # every process writes its own temporary directory, parallel runs on the same dataset keep
+        # the first finished copy
+        tmp_path = path+'.'+str(os.getpid())+'.tmp'
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, split in zip(names, splits):
+            np.save(os.path.join(tmp_path, name+'.npy'), np.asarray(split))
+        with open(os.path.join(tmp_path, 'classes.json'), 'w') as f:
+            json.dump(list(splits[4]), f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            if not os.path.exists(path):
+                raise
+            shutil.rmtree(tmp_path)
+    else:
+        print("Loading preprocessed dataset from "+path)
+
+    splits = [np.load(os.path.join(path, name+'.npy'), mmap_mode='r') for name in names]
+    with open(os.path.join(path, 'classes.json')) as f:
+        classes = json.load(f)
+    return splits[0], splits[1], splits[2], splits[3], classes
+
+# return train and test tf.data pipelines that stream the images of a synthetic dataset from disk
+# the files of every class are split 4:1 into train and test, images are decoded and resized in
+# parallel and prefetched so decoding overlaps with training, cache is None to decode every epoch,
+# '' to cache the decoded images in memory or a file prefix to cache them on disk
+def build_streaming_datasets(datatype,details,num_of_classes,seed=42,cache=None):
+    resize_x = details[1]
+    resize_y = details[2]
+    global_batch_size = details[4]
+    data_dir = data_dirs[datatype]
+    shard = load_shard(datatype)
+
+    if shard is not None:
+        # read the images from the memory-mapped shard
+        images, labels, classes = shard
+        sources = np.arange(len(labels))
+        shape = images.shape[1:]
+
+        def read_image(index):
+            return tf.numpy_function(lambda i: images[i], [index], tf.uint8)
+    else:
+        # the classes are the sorted subdirectories like in image_dataset_from_directory
+        classes = sorted(d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d)))
+        sources = []
+        labels = []
+        for label, name in enumerate(classes):
+            files = sorted(f for f in os.listdir(os.path.join(data_dir, name)) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')))
+            sources += [os.path.join(data_dir, name, f) for f in files]
+            labels += [label]*len(files)
+        sources = np.array(sources)
+        labels = np.array(labels, dtype=np.int32)
+        shape = [None, None, 3]
+
+        def read_image(path):
+            return tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+
+    train_indicies, test_indicies = stratified_split(labels, len(classes), seed)
+
+    # decode an image to float32 values in 0-255, the same as image_dataset_from_directory
+    def load_image(source, label):
+        image = read_image(source)
+        image.set_shape(shape)
+        image = tf.image.resize(image, (resize_x, resize_y))
+        image.set_shape([resize_x, resize_y, 3])
+        return image, label
+
+    def pipeline(indicies, training):
+        dataset = tf.data.Dataset.from_tensor_slices((sources[indicies], labels[indicies]))
+        if training:
+            dataset = dataset.shuffle(len(indicies), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.map(load_image, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not training)
+        if cache is not None:
+            dataset = dataset.cache(cache+('_train' if training else '_test') if cache else '')
+
+            # the cache replays the first epoch in order, shuffle again within a bounded buffer
+            if training:
+                dataset = dataset.shuffle(16*global_batch_size, seed=seed, reshuffle_each_iteration=True)
+        return dataset.batch(global_batch_size).prefetch(tf.data.AUTOTUNE)
+
+    print("Streaming "+str(len(train_indicies))+" training and "+str(len(test_indicies))+" testing images from "+data_dir)
+    return pipeline(train_indicies, True), pipeline(test_indicies, False), classes
+
+# yield float32 batches of the synthetic CHANNELS data on demand
+# every sample is uniform noise in [0, 1) with 0.5 added to the channels-n_classes+1 channels
+# starting at the channel of its class, labels cycle through the classes and are shuffled within
+# each batch, every batch has its own seed so batches can be generated independently
+def generate_channels(n_samples, batch_size, resize_x=10, resize_y=10, channels=12, n_classes=10, seed=42):
+    if not 0 < n_classes <= channels:
+        raise ValueError("CHANNELS needs between 1 and "+str(channels)+" classes for "+str(channels)+" channels, got "+str(n_classes))
+    classes_to_add_to = channels-n_classes+1
+    signal = np.zeros((n_classes, channels), dtype=np.float32)
+    for i in range(n_classes):
+        signal[i, i:i+classes_to_add_to] = 0.5
+
+    for start in range(0, n_samples, batch_size):
+        rng = np.random.default_rng([seed, start])
+        size = min(batch_size, n_samples - start)
+        y = rng.permutation(np.arange(start, start+size) % n_classes).astype(np.int32)
+        x = rng.random((size, resize_x, resize_y, channels), dtype=np.float32)
+        x += signal[y][:, None, None, :]
+        yield x, y
+
+# the names of the CHANNELS classes, the range of channels the signal is added to
+def channel_classes(channels, n_classes):
+    return [str(i)+'-'+str(i+channels-n_classes) for i in range(n_classes)]
+
+# return train and test tf.data pipelines that generate the synthetic CHANNELS data on demand, with the classes
+def build_channels_datasets(details,train_size,test_size,channels=12,n_classes=10,seed=42):
+    resize_x = details[1]
+    resize_y = details[2]
+    global_batch_size = details[4]
+    signature = (tf.TensorSpec([None, resize_x, resize_y, channels], tf.float32), tf.TensorSpec([None], tf.int32))
+
+    def pipeline(n_samples, seed):
+        return tf.data.Dataset.from_generator(lambda: generate_channels(n_samples, global_batch_size, resize_x, resize_y, channels, n_classes, seed),
+                                              output_signature=signature).prefetch(tf.data.AUTOTUNE)
+
+    return pipeline(train_size, seed), pipeline(test_size, seed+1), channel_classes(channels, n_classes)
+
+def preprocess_datasets(datatype,details,num_of_classes,seed=42,channels=12,samples=None):
     
     resize_x = details[1]
     resize_y = details[2]
@@ -64,68 +266,48 @@ def build_model_datasets(datatype,details,num_of_classes):
         # load CIFAR-10 dataset
         (full_x_train, full_y_train), (full_x_test, full_y_test) = tf.keras.datasets.cifar10.load_data()
         
-        # normalize CIFAR-10 dataset to 0.0-1.0
-        full_x_train, full_x_test = full_x_train/255.0, full_x_test/255.0
-        
-        # pick classes out of CIFAR-10
-        full_x_train = full_x_train[np.isin(full_y_train, class_indicies).flatten()]
-        full_y_train = full_y_train[np.isin(full_y_train, class_indicies).flatten()]
-        full_x_test = full_x_test[np.isin(full_y_test, class_indicies).flatten()]
-        full_y_test = full_y_test[np.isin(full_y_test, class_indicies).flatten()]
-        
-        
         # ensure the same number of pictures of each class are in the training/test set
         train_images_per_class = datasize(datatype,num_of_classes)[0]//len(classes)
         print("Training Images Per Class: "+str(train_images_per_class))
         test_images_per_class = datasize(datatype,num_of_classes)[1]//len(classes)
         print("Testing Images Per Class: "+str(test_images_per_class))
-        
-        x_train = []
-        x_test = []
-        y_train = []
-        y_test = []
-        
-        for i in tqdm(range(len(full_y_train)),desc='Filtering Training Images'):
-            if y_train.count(full_y_train[i]) < train_images_per_class:
-                x_train.append(full_x_train[i])
-                y_train.append(full_y_train[i])
-        
-        for i in tqdm(range(len(full_y_test)),desc='Filtering Testing Images'):
-            if y_test.count(full_y_test[i]) < test_images_per_class:
-                x_test.append(full_x_test[i])
-                y_test.append(full_y_test[i])
-        
-        x_train = np.array(x_train)
-        x_test = np.array(x_test)
-        y_train = np.array(y_train)
-        y_test = np.array(y_test)
-
-        for x in range(len(class_indicies)):
-            y_train[y_train == class_indicies[x]] = x
-            y_test[y_test == class_indicies[x]] = x
-        
+
+        # pick the images of the chosen classes before any conversion of the full arrays
+        train_indicies, = balanced_split(full_y_train, class_indicies, [train_images_per_class], seed)
+        test_indicies, = balanced_split(full_y_test, class_indicies, [test_images_per_class], seed)
+        x_train, y_train = full_x_train[train_indicies], full_y_train[train_indicies]
+        x_test, y_test = full_x_test[test_indicies], full_y_test[test_indicies]
+
+        # relabel the chosen classes as 0..len(classes)-1
+        relabel = np.zeros(len(full_classes), dtype=full_y_train.dtype)
+        relabel[class_indicies] = np.arange(len(class_indicies))
+        y_train, y_test = relabel[y_train], relabel[y_test]
+
         print("Train Shape: "+str(np.shape(x_train)))
         print("Test Shape: "+str(np.shape(x_test)))
-            
-        x_train,y_train = shuffle(x_train,y_train)
-        x_test,y_test = shuffle(x_test,y_test)
-        
-        # resize CIFAR-10 data
-        x_train, x_test = tf.image.resize(x_train[:,:,:datasize(datatype,num_of_classes)[0]], (resize_x,resize_y)).numpy(), tf.image.resize(x_test[:,:,:datasize(datatype,num_of_classes)[1]], (resize_x,resize_y)).numpy()
-        
-        # truncate CIFAR-10 dataset to specified train/test size
-        x_train, x_test = x_train[:datasize(datatype,num_of_classes)[0]], x_test[:datasize(datatype,num_of_classes)[1]]
-        y_train, y_test = y_train[:datasize(datatype,num_of_classes)[0]], y_test[:datasize(datatype,num_of_classes)[1]]      
-        
+
+        # normalize CIFAR-10 dataset to 0.0-1.0 and resize
+        x_train = tf.image.resize(x_train.astype(np.float32)/255.0, (resize_x,resize_y)).numpy()
+        x_test = tf.image.resize(x_test.astype(np.float32)/255.0, (resize_x,resize_y)).numpy()
+
         return x_train, x_test, y_train, y_test, classes
 
     if datatype == "COLORS" or datatype == "COLORS_SHAPE":
+        data_dir = data_dirs[datatype]
+
+        # read the dataset from its shard if it was written as one
+        shard = load_shard(datatype)
+        if shard is not None:
+            images, labels, classes = shard
+            train_indicies, test_indicies = stratified_split(labels, len(classes), seed)
+            x_train = tf.image.resize(images[train_indicies], (resize_x, resize_y)).numpy()
+            x_test = tf.image.resize(images[test_indicies], (resize_x, resize_y)).numpy()
+            return x_train, x_test, labels[train_indicies], labels[test_indicies], classes
+
         if datatype == "COLORS":
-            data_dir = './mixed_colors/noisy_colors'
             classes = ['blue','cyan','cyan_tert','green','magenta','magenta_tert','red','yellow','yellow_tert']
         
         if datatype == "COLORS_SHAPE":
-            data_dir = './mixed_colors_shapes/noisy_colors'
             classes = ['blue','blue_corner','blue_plus','blue_x',
                         'cyan','cyan_corner','cyan_plus','cyan_x',
                         'green','green_corner','green_plus','green_x',
@@ -136,7 +318,7 @@ def build_model_datasets(datatype,details,num_of_classes):
         # import the dataset from the directory, create batches, and shuffle data
         dataset = tf.keras.preprocessing.image_dataset_from_directory(
             data_dir,
-            seed=42,
+            seed=seed,
             batch_size = global_batch_size,
             shuffle=True,
             image_size=(resize_x, resize_y))
@@ -172,45 +354,10 @@ def build_model_datasets(datatype,details,num_of_classes):
         return x_train, x_test, y_train, y_test, classes
         
     if datatype == "CHANNELS":
-        # specify desired number of channels and classes
-        channels = 12 
-        n_classes = 10
-        
-        # number of channels to add scalar to for each class
-        classes_to_add_to = channels-n_classes+1
-
-        train_class_size = int(datasize(datatype,num_of_classes)[0]/n_classes)
-        test_class_size = int(datasize(datatype,num_of_classes)[1]/n_classes)
-        
-        x_train = np.array([], dtype=np.int64).reshape(0,resize_x,resize_y,channels)
-        y_train = np.array([]*train_class_size)
-        x_test = np.array([], dtype=np.int64).reshape(0,resize_x,resize_y,channels)
-        y_test = np.array([]*test_class_size)
-
-        # create synthetic training and testing data and labels
-        for i in range(n_classes):
-        
-            x_training_class = np.random.rand(train_class_size,resize_x,resize_y,channels)
-            
-            y_training_class = np.array([i]*train_class_size)
-            
-            # create test sets similarly
-            x_test_class = np.random.rand(test_class_size,resize_x,resize_y,channels)
-            y_test_class = np.array([i]*test_class_size)
-            
-            for j in range(classes_to_add_to):
-                x_training_class[...,i+j] += 0.5 
-                x_test_class[...,i+j] += 0.5 
-            
-            # compile all classes to form final datasets
-            x_train = np.concatenate((x_train,x_training_class))
-            y_train = np.concatenate((y_train,y_training_class))
-            x_test = np.concatenate((x_test,x_test_class))
-            y_test = np.concatenate((y_test,y_test_class))
-
-        # shuffle the newly generated data
-        x_train,y_train = shuffle(x_train,y_train)
-        x_test,y_test = shuffle(x_test,y_test)
-        classes = ['0-2','1-3','2-4','3-5','4-6','5-7','6-8','7-9','8-10','9-11']
+        # create synthetic training and testing data and labels of num_of_classes classes in a single batch each
+        train_size, test_size = datasize(datatype,num_of_classes,samples)
+        x_train, y_train = next(generate_channels(train_size, train_size, resize_x, resize_y, channels, num_of_classes, seed))
+        x_test, y_test = next(generate_channels(test_size, test_size, resize_x, resize_y, channels, num_of_classes, seed+1))
+        classes = channel_classes(channels, num_of_classes)
         
         return x_train, x_test, y_train, y_test, classes
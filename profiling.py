@@ -0,0 +1,153 @@
+# import packages
+import os
+import time
+import resource
+import tensorflow as tf
+
+#######################
+# per layer profiling of the quantum layers and throughput of the training run
+#
+# a quantum layer with a profiler marks the boundaries of its stages in its graph with small
+# py_function ops that record the wall time when the tensors of a stage are computed. the time
+# from the start of a step to the first mark is spent in the input pipeline and the layers before
+# the quantum layer, the rest of the step (the backward pass, the dense head and the optimizer)
+# is the difference between the step time and the marked stages. the marks order the stages of
+# the forward pass, so they are only added while profiling
+
+# stages of a forward pass of a quantum layer
+stages = ["input", "patches", "simulation", "postprocessing"]
+
+class Layer_profiler:
+
+    # initialize class
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.totals = {phase: dict({stage: 0.0 for stage in stages}, samples=0, circuits=0, calls=0) for phase in ["train", "test"]}
+        self.last = None
+        self.step_started = False
+
+    # called by the callback when a step starts, the first mark of the step records the input stage
+    def begin_step(self):
+        self.last = time.perf_counter()
+        self.step_started = True
+
+    # return tensor after recording the time it was computed at, stage is the stage that ends here
+    # or "start" for the mark at the beginning of the layer
+    def mark(self, tensor, stage, training=None, samples=0, circuits=0):
+        phase = "train" if isinstance(training, bool) and training else "test"
+
+        def record(_, samples, circuits):
+            now = time.perf_counter()
+            totals = self.totals[phase]
+            if stage == "start":
+                if self.step_started:
+                    totals["input"] += now - self.last
+                    self.step_started = False
+                totals["samples"] += int(samples)
+                totals["calls"] += 1
+            else:
+                totals[stage] += now - self.last
+                totals["circuits"] += int(circuits)
+            self.last = now
+            return 0.0
+
+        # the mark waits for a single element of the tensor, which needs the whole tensor
+        done = tf.py_function(record, [tf.reshape(tensor, [-1])[:1], samples, circuits], Tout=tf.float32)
+        with tf.control_dependencies([done]):
+            return tf.identity(tensor)
+
+#############################
+# peak memory of the run in MB, the peak of the GPUs if there are any and of the process otherwise
+def peak_memory():
+    gpus = tf.config.list_logical_devices('GPU')
+    if gpus:
+        return sum(tf.config.experimental.get_memory_info(gpu.name)['peak'] for gpu in gpus)/2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+# keras callback that profiles the quantum layers of a model every epoch and writes the results
+# to <output_dir>/<time>_profile.csv, with trace a TF profiler trace of the steps in
+# trace_steps of the first epoch is written to <output_dir>/trace for TensorBoard
+class Profiling(tf.keras.callbacks.Callback):
+
+    # initialize class, the profilers are attached to the layers here because the marks are added
+    # when the layers are traced, which happens at the start of fit
+    def __init__(self, model, output_dir, trace=False, trace_steps=(2, 5)):
+        super().__init__()
+        self.output_dir = output_dir
+        self.trace = trace
+        self.trace_steps = trace_steps
+        self.tracing = False
+        self.layers = [layer for layer in model.layers if hasattr(layer, 'profiler')]
+        for layer in self.layers:
+            layer.profiler = Layer_profiler()
+        self.records = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        for layer in self.layers:
+            layer.profiler.reset()
+        for gpu in tf.config.list_logical_devices('GPU'):
+            tf.config.experimental.reset_memory_stats(gpu.name)
+        self.step_seconds = {"train": 0.0, "test": 0.0}
+        self.epoch_start = time.perf_counter()
+
+    def begin_step(self):
+        for layer in self.layers:
+            layer.profiler.begin_step()
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.trace and self.epoch == 0 and batch == self.trace_steps[0]:
+            tf.profiler.experimental.start(os.path.join(self.output_dir, 'trace'))
+            self.tracing = True
+        self.begin_step()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step_seconds["train"] += time.perf_counter() - self.step_start
+        if self.tracing and batch + 1 >= self.trace_steps[1]:
+            self.stop_trace()
+
+    def on_test_batch_begin(self, batch, logs=None):
+        self.begin_step()
+
+    def on_test_batch_end(self, batch, logs=None):
+        self.step_seconds["test"] += time.perf_counter() - self.step_start
+
+    def stop_trace(self):
+        tf.profiler.experimental.stop()
+        self.tracing = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.tracing:
+            self.stop_trace()
+        record = {"epoch": epoch + 1, "seconds": time.perf_counter() - self.epoch_start}
+        for phase in ["train", "test"]:
+            totals = [layer.profiler.totals[phase] for layer in self.layers]
+            samples = totals[0]["samples"] if totals else 0
+            record[phase+"_step_seconds"] = self.step_seconds[phase]
+            record[phase+"_samples_per_second"] = samples/self.step_seconds[phase] if self.step_seconds[phase] else 0.0
+            for layer, layer_totals in zip(self.layers, totals):
+                for stage in stages:
+                    record[phase+"_"+layer.name+"_"+stage+"_seconds"] = layer_totals[stage]
+                record[phase+"_"+layer.name+"_circuits_per_second"] = layer_totals["circuits"]/layer_totals["simulation"] if layer_totals["simulation"] else 0.0
+            # the backward pass, the classical layers and the optimizer
+            record[phase+"_other_seconds"] = self.step_seconds[phase] - sum(t[stage] for t in totals for stage in stages)
+        record["peak_memory_mb"] = peak_memory()
+        self.records.append(record)
+
+        print("Profile: "+str(round(record["train_samples_per_second"], 1))+" samples/s, "+
+              ", ".join(layer.name+" "+str(round(record["train_"+layer.name+"_circuits_per_second"]))+" circuits/s" for layer in self.layers)+
+              ", peak memory "+str(round(record["peak_memory_mb"]))+" MB")
+
+    def on_train_end(self, logs=None):
+        if self.tracing:
+            self.stop_trace()
+        if not self.records:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, time.strftime("%Y%m%d-%H%M%S")+"_profile.csv"), 'w') as f:
+            print(",".join(self.records[0].keys()), file=f)
+            for record in self.records:
+                print(",".join(str(v) for v in record.values()), file=f)
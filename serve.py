@@ -0,0 +1,257 @@
+# import packages
+import argparse
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import http.client
+from concurrent.futures import Future, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import tensorflow as tf
+import numpy as np
+
+# import project functions, importing circuits registers the quantum layers for load_model
+import circuits
+from surrogate import load_surrogate
+from expectation_cache import Expectation_cache, hit_rates
+from utils import normalize_channels
+
+#######################
+# local inference server for trained models
+#
+# a model saved by train.py (output/<time>_<model>/model.keras) is served over HTTP on a port or
+# a unix socket. POST /predict takes a single image [height, width, channels] or a batch of images
+# as a .npy file and returns the class probabilities as a .npy file, GET /health returns the
+# statistics of the server as json. requests are queued and coalesced by a single worker thread
+# into batches of at most max_batch_size images, a batch is evaluated as soon as it is full or
+# max_latency after its first request arrived, so concurrent single image requests share one
+# evaluation of the quantum layer
+
+# encode and decode arrays in the .npy format, pickled objects are never loaded
+def encode_array(array):
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+def decode_array(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+# load a saved model and return it with a function that predicts a batch, the channels are
+# normalized here if the model expects them normalized by the input pipeline as in train.py, with
+# the training set statistics saved in the quantum layer or per sample if it has none. with
+# surrogate_path the quantum layer evaluates the surrogate written by surrogate.py and with
+# cache_size it caches that many patches instead of the cache_size the model was saved with
+def load_predict_function(path, surrogate_path=None, cache_size=None):
+    model = tf.keras.models.load_model(path)
+    quantum_layer = [layer for layer in model.layers if hasattr(layer, 'normalizes_inputs')][0]
+    if cache_size is not None:
+        quantum_layer.cache_size = cache_size
+        quantum_layer.cache = Expectation_cache(quantum_layer.simulator, cache_size, quantum_layer.cache_decimals) if cache_size else None
+    if surrogate_path:
+        quantum_layer.surrogate = load_surrogate(surrogate_path)
+    normalize = quantum_layer.normalizes_inputs and quantum_layer.normalization == 'pipeline'
+    if quantum_layer.normalizes_inputs and quantum_layer.normalization == 'batch':
+        print("Warning: "+quantum_layer.name+" normalizes with batch statistics, predictions depend on the requests batched together")
+
+    # a single trace for every batch size
+    @tf.function(input_signature=[tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32)])
+    def predict(x):
+        if normalize:
+            x = normalize_channels(x, quantum_layer.datatype, quantum_layer.channel_stats)
+        return model(x, training=False)
+    return model, predict
+
+#############################
+# coalesces the queued requests into batches that are evaluated by a single worker thread
+class Micro_batcher:
+
+    # initialize class, max_latency is in seconds and max_queue is the number of waiting requests
+    def __init__(self, predict, max_batch_size=32, max_latency=0.005, max_queue=256):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue(max_queue)
+
+        # statistics
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_samples = 0
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    # queue a batch of images, returns a future of the predictions, raises queue.Full if the
+    # queue holds max_queue requests
+    def submit(self, x):
+        future = Future()
+        self.requests.put_nowait((x, future))
+        return future
+
+    # wait for a request and collect more until the batch is full or its latency runs out
+    def next_batch(self):
+        batch = [self.requests.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_latency
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+            size += len(batch[-1][0])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                outputs = self.predict(np.concatenate([x for x, _ in batch])).numpy()
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for x, future in batch:
+                future.set_result(outputs[start:start+len(x)])
+                start += len(x)
+            self.n_requests += len(batch)
+            self.n_batches += 1
+            self.n_samples += start
+
+    def statistics(self):
+        return {"requests": self.n_requests,
+                "batches": self.n_batches,
+                "samples": self.n_samples,
+                "mean_batch_size": self.n_samples/self.n_batches if self.n_batches else 0.0,
+                "queue_depth": self.requests.qsize()}
+
+#############################
+class Predict_handler(BaseHTTPRequestHandler):
+
+    # the server has a batcher, the input shape of the model and a request timeout in seconds
+    def do_POST(self):
+        if self.path != '/predict':
+            return self.send_error(404)
+        try:
+            x = decode_array(self.rfile.read(int(self.headers['Content-Length'])))
+        except (ValueError, TypeError, OSError) as e:
+            return self.send_error(400, "Expected a .npy array: "+str(e))
+
+        # a single image is a batch of one
+        x = x.astype(np.float32, copy=False)
+        if x.ndim == len(self.server.input_shape):
+            x = x[None]
+        if x.shape[1:] != self.server.input_shape or len(x) == 0:
+            return self.send_error(400, "Expected images of shape "+str(self.server.input_shape)+", got "+str(x.shape))
+
+        try:
+            future = self.server.batcher.submit(x)
+        except queue.Full:
+            return self.send_error(503, "The request queue is full")
+        try:
+            output = future.result(timeout=self.server.request_timeout)
+        except TimeoutError:
+            return self.send_error(504, "The prediction timed out")
+        except Exception as e:
+            return self.send_error(500, str(e))
+        self.send_body(encode_array(output), 'application/x-npy')
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_error(404)
+        self.send_body(json.dumps(dict(self.server.batcher.statistics(), model=self.server.model.name, input_shape=self.server.input_shape,
+                                       cache_hit_rate=hit_rates(self.server.model))).encode(), 'application/json')
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # the client address of a unix socket is empty, requests are not logged
+    def log_message(self, format, *args):
+        pass
+
+# connections waiting to be accepted, bursts of concurrent clients exceed the default of 5
+class Http_server(ThreadingHTTPServer):
+    request_queue_size = 128
+
+class Unix_http_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+# create the server for a saved model on a port or, if unix_socket is given, on a unix socket
+def create_server(model_path, host='127.0.0.1', port=8500, unix_socket=None, max_batch_size=32, max_latency=0.005, max_queue=256, request_timeout=30.0, surrogate_path=None, cache_size=None):
+    model, predict = load_predict_function(model_path, surrogate_path, cache_size)
+    input_shape = tuple(model.input_shape[1:])
+
+    # trace the prediction function before the first request
+    predict(np.zeros((1,) + input_shape, dtype=np.float32))
+
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = Unix_http_server(unix_socket, Predict_handler)
+    else:
+        server = Http_server((host, port), Predict_handler)
+    server.batcher = Micro_batcher(predict, max_batch_size, max_latency, max_queue)
+    server.input_shape = input_shape
+    server.model = model
+    server.request_timeout = request_timeout
+    return server
+
+#############################
+# client side, predict a single image or a batch of images with a running server
+class Unix_http_connection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_socket = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+def request_prediction(x, host='127.0.0.1', port=8500, unix_socket=None, timeout=60):
+    connection = Unix_http_connection(unix_socket, timeout) if unix_socket else http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('POST', '/predict', body=encode_array(np.asarray(x, dtype=np.float32)), headers={'Content-Type': 'application/x-npy'})
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError("Prediction failed with "+str(response.status)+": "+response.reason)
+        return decode_array(body)
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a trained model with dynamic micro-batching.")
+    parser.add_argument("model", help="model saved by train.py, e.g. output/<time>_<model>/model.keras")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8500)
+    parser.add_argument("--unix-socket", help="listen on this unix socket instead of a port")
+    parser.add_argument("--max-batch-size", type=int, default=32, help="images evaluated together")
+    parser.add_argument("--max-latency-ms", type=float, default=5.0, help="time a request waits for others to join its batch")
+    parser.add_argument("--max-queue", type=int, default=256, help="waiting requests before new ones are rejected with 503")
+    parser.add_argument("--request-timeout", type=float, default=30.0, help="seconds before a request fails with 504")
+    parser.add_argument("--cache-size", type=int, help="patches cached by the quantum layer, 0 disables the cache (default: as saved)")
+    parser.add_argument("--surrogate", help="evaluate the quantum layer with this surrogate written by surrogate.py")
+    args = parser.parse_args()
+
+    server = create_server(args.model, args.host, args.port, args.unix_socket, args.max_batch_size, args.max_latency_ms/1000, args.max_queue, args.request_timeout, args.surrogate, args.cache_size)
+    print("Serving "+server.model.name+" on "+(args.unix_socket or args.host+":"+str(args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
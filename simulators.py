@@ -0,0 +1,531 @@
+# import packages
+import tensorflow as tf
+import cirq
+import sympy
+import numpy as np
+
+from closed_form import Closed_form_simulator
+
+# tensorflow quantum is only needed for the "tfq" backend, it is imported when the backend is
+# created since importing it initializes the tensorflow runtime (see configure_cpu_devices)
+tfq = None
+
+# every simulator is called with
+#   input_data: tensor of shape [n_groups, n_rows, n_input_params] holding the encoded pixel values
+#   controller: tensor of shape [n_groups, n_kernels, n_learning_params] holding the kernel values
+# and returns the expectation values of shape [n_groups, n_kernels, n_rows], every row of a
+# group is evaluated against every kernel of the same group
+
+#######################
+# evaluate the circuit with tfq.layers.Expectation
+class TFQ_simulator:
+
+    # initialize class
+    def __init__(self, circuit, input_params, learning_params, measurement):
+        global tfq
+        try:
+            import tensorflow_quantum as tfq
+        except ImportError:
+            raise ImportError("The 'tfq' backend requires tensorflow_quantum, use backend='statevector' instead")
+        self.circuit = circuit
+        self.params = list(input_params) + list(learning_params)
+        self.n_input_params = len(input_params)
+        self.n_learning_params = len(learning_params)
+        self.measurement = measurement
+
+        # create a single expectation layer, the circuit is passed once and
+        # broadcast against the batch of parameter rows
+        self.expectation = tfq.layers.Expectation()
+
+    def __call__(self, input_data, controller):
+        n_groups = tf.shape(input_data)[0]
+        n_rows = tf.shape(input_data)[1]
+        n_kernels = tf.shape(controller)[1]
+
+        # pair every row with every kernel of its group
+        input_data = tf.broadcast_to(input_data[:, None, :, :], [n_groups, n_kernels, n_rows, self.n_input_params])
+        controller = tf.broadcast_to(controller[:, :, None, :], [n_groups, n_kernels, n_rows, self.n_learning_params])
+        symbol_values = tf.reshape(tf.concat([input_data, controller], 3), shape=[-1, len(self.params)])
+
+        # get expectation value for each data point for each kernel in a single call
+        output = self.expectation(self.circuit,
+                                  symbol_names=self.params,
+                                  symbol_values=symbol_values,
+                                  operators=self.measurement)
+
+        return tf.reshape(output, shape=[n_groups, n_kernels, n_rows])
+
+#######################
+# simulate the circuit natively as a batched statevector in tensorflow
+#
+# supports the gate set used by the layers in circuits.py (H, X/rx powers, Z powers,
+# CXPow and CZPow) with exponents that are constant or linear in a single symbol.
+# Gradients for the kernel exponents are exact and come from tensorflow autodiff.
+class Statevector_simulator:
+
+    # apply every run of diagonal gates as a single phase
+    fuse_diagonal = True
+
+    # initialize class
+    def __init__(self, circuit, input_params, learning_params, measurement):
+        self.qubits = self.order_qubits(circuit)
+        self.n_qubits = len(self.qubits)
+        self.input_index = {str(p): i for i, p in enumerate(input_params)}
+        self.learning_index = {str(p): i for i, p in enumerate(learning_params)}
+
+        # parse the circuit into a list of (gate type, qubit indices, exponent)
+        self.operations = [self.parse_operation(op) for op in circuit.all_operations()]
+        if self.fuse_diagonal:
+            self.operations = self.fuse_operations(self.operations)
+        self.observable = self.parse_measurement(measurement)
+
+    # define the order of the qubits in the simulated state
+    def order_qubits(self, circuit):
+        return sorted(circuit.all_qubits())
+
+    # describe an exponent as a constant or as coefficient*symbol + offset
+    def parse_exponent(self, exponent):
+        if not cirq.is_parameterized(exponent):
+            return float(exponent)
+
+        symbols = list(exponent.free_symbols)
+        if len(symbols) != 1:
+            raise ValueError("Exponent "+str(exponent)+" must depend on exactly one symbol")
+        symbol = symbols[0]
+        coefficient = exponent.diff(symbol)
+        if coefficient.free_symbols:
+            raise ValueError("Exponent "+str(exponent)+" must be linear in "+str(symbol))
+
+        if str(symbol) in self.input_index:
+            source, index = "input", self.input_index[str(symbol)]
+        elif str(symbol) in self.learning_index:
+            source, index = "kernel", self.learning_index[str(symbol)]
+        else:
+            raise ValueError("Unknown symbol "+str(symbol))
+        return (source, index, float(coefficient), float(exponent.subs(symbol, 0)))
+
+    def parse_operation(self, op):
+        gate = op.gate
+        qubits = [self.qubits.index(q) for q in op.qubits]
+
+        # check controlled gates before their single qubit base classes
+        if isinstance(gate, cirq.CXPowGate):
+            kind = "CX"
+        elif isinstance(gate, cirq.CZPowGate):
+            kind = "CZ"
+        elif isinstance(gate, cirq.XPowGate):
+            kind = "X"
+        elif isinstance(gate, cirq.ZPowGate):
+            kind = "Z"
+        elif isinstance(gate, cirq.HPowGate) and gate.exponent == 1:
+            kind = "H"
+        else:
+            raise ValueError("Gate "+str(op)+" is not supported by the statevector simulator")
+
+        # global phases never change an expectation value, so global_shift is ignored
+        return kind, qubits, self.parse_exponent(getattr(gate, "exponent", 1.0))
+
+    # merge runs of Z and CZ powers into ("DIAG", qubit indices, [(qubit indices, exponent), ...]),
+    # the phase of a basis state is pi times the sum of the exponents of the gates whose qubits are all 1
+    def fuse_operations(self, operations):
+        fused = []
+        for operation in operations:
+            if operation[0] in ("Z", "CZ"):
+                if fused and fused[-1][0] in ("Z", "CZ", "DIAG"):
+                    previous = fused.pop()
+                    terms = previous[2] if previous[0] == "DIAG" else [(previous[1], previous[2])]
+                    terms = terms + [(operation[1], operation[2])]
+                    operation = ("DIAG", sorted(set(q for qubits, _ in terms for q in qubits)), terms)
+            fused.append(operation)
+        return fused
+
+    # whether an operation depends on the input data
+    def encodes_data(self, operation):
+        exponents = [e for _, e in operation[2]] if operation[0] == "DIAG" else [operation[2]]
+        return any(not isinstance(e, float) and e[0] == "input" for e in exponents)
+
+    def parse_measurement(self, measurement):
+        pauli_string = cirq.PauliString(measurement)
+        paulis = [(self.qubits.index(q), str(p)) for q, p in pauli_string.items()]
+        return complex(pauli_string.coefficient), paulis
+
+    # return the exponent of an operation as a tensor broadcastable to [n_groups, n_kernels, n_rows]
+    def get_exponent(self, exponent, input_data, controller):
+        if isinstance(exponent, float):
+            return tf.constant(exponent, shape=[1, 1, 1])
+        source, index, coefficient, offset = exponent
+        if source == "input":
+            value = input_data[:, None, :, index]
+        else:
+            value = controller[:, :, None, index]
+        return coefficient*value + offset
+
+    # reshape a per-row coefficient so it broadcasts against a state of the given rank
+    def expand(self, value, rank):
+        return tf.reshape(value, shape=tf.concat([tf.shape(value), tf.ones([rank - 3], dtype=tf.int32)], 0))
+
+    # apply a 2x2 matrix, given as four broadcastable entries, to one qubit axis of the state
+    def apply_single(self, state, axis, matrix):
+        m00, m01, m10, m11 = matrix
+        s0, s1 = tf.unstack(state, axis=axis)
+        rank = len(s0.shape)
+        m00, m01, m10, m11 = [self.expand(m, rank) for m in (m00, m01, m10, m11)]
+        return tf.stack([m00*s0 + m01*s1, m10*s0 + m11*s1], axis=axis)
+
+    # apply a matrix only where the control qubit is in state 1
+    def apply_controlled(self, state, control_axis, target_axis, matrix):
+        s0, s1 = tf.unstack(state, axis=control_axis)
+        if target_axis > control_axis:
+            target_axis = target_axis - 1
+        s1 = self.apply_single(s1, target_axis, matrix)
+
+        # the controlled half may have been broadcast against new data or kernel rows
+        shape = tf.broadcast_dynamic_shape(tf.shape(s0), tf.shape(s1))
+        return tf.stack([tf.broadcast_to(s0, shape), tf.broadcast_to(s1, shape)], axis=control_axis)
+
+    # matrix entries of X**t with zero global shift
+    def x_pow(self, t):
+        phase = tf.exp(tf.complex(tf.zeros_like(t), np.pi*t/2))
+        cos = tf.complex(tf.cos(np.pi*t/2), tf.zeros_like(t))
+        sin = tf.complex(tf.zeros_like(t), -tf.sin(np.pi*t/2))
+        return phase*cos, phase*sin, phase*sin, phase*cos
+
+    # matrix entries of Z**t with zero global shift
+    def z_pow(self, t):
+        one = tf.ones_like(tf.complex(t, t))
+        zero = tf.zeros_like(one)
+        return one, zero, zero, tf.exp(tf.complex(tf.zeros_like(t), np.pi*t))
+
+    # multiply the state by the phases of a run of diagonal gates
+    def apply_diagonal(self, state, terms, input_data, controller):
+        rank = 3 + self.n_qubits
+        phase = 0
+        for qubits, exponent in terms:
+            # 1 where all qubits of the gate are 1, broadcast over the other qubits
+            mask = np.zeros([2 if q in qubits else 1 for q in range(self.n_qubits)], dtype=np.float32)
+            mask[tuple(1 if q in qubits else 0 for q in range(self.n_qubits))] = 1
+            t = self.expand(self.get_exponent(exponent, input_data, controller), rank)
+            phase = phase + t*mask[None, None, None]
+        return state*tf.exp(tf.complex(tf.zeros_like(phase), np.pi*phase))
+
+    # apply a list of parsed operations to the state
+    def apply_operations(self, state, operations, input_data, controller):
+        for kind, qubits, exponent in operations:
+            axes = [q + 3 for q in qubits]
+            if kind == "DIAG":
+                state = self.apply_diagonal(state, exponent, input_data, controller)
+                continue
+            if kind == "H":
+                h = tf.constant(1/np.sqrt(2), shape=[1, 1, 1], dtype=tf.complex64)
+                state = self.apply_single(state, axes[0], (h, h, h, -h))
+                continue
+
+            t = self.get_exponent(exponent, input_data, controller)
+            if kind == "X":
+                state = self.apply_single(state, axes[0], self.x_pow(t))
+            elif kind == "Z":
+                state = self.apply_single(state, axes[0], self.z_pow(t))
+            elif kind == "CX":
+                state = self.apply_controlled(state, axes[0], axes[1], self.x_pow(t))
+            elif kind == "CZ":
+                state = self.apply_controlled(state, axes[0], axes[1], self.z_pow(t))
+        return state
+
+    # initialize |0...0> with shape [1, 1, 1, 2, ..., 2], it broadcasts out as gates are applied
+    def initial_state(self):
+        return tf.reshape(tf.one_hot(0, 2**self.n_qubits, dtype=tf.complex64), shape=[1, 1, 1] + [2]*self.n_qubits)
+
+    def __call__(self, input_data, controller):
+        input_data = tf.cast(input_data, tf.float32)
+        controller = tf.cast(controller, tf.float32)
+
+        state = self.apply_operations(self.initial_state(), self.operations, input_data, controller)
+        return self.expectation(state, input_data, controller)
+
+    # compute <psi|P|psi> for the measured pauli string
+    def expectation(self, state, input_data, controller):
+        coefficient, paulis = self.observable
+        pauli_state = state
+        for qubit, pauli in paulis:
+            s0, s1 = tf.unstack(pauli_state, axis=qubit + 3)
+            if pauli == "X":
+                s0, s1 = s1, s0
+            elif pauli == "Y":
+                s0, s1 = -1j*s1, 1j*s0
+            elif pauli == "Z":
+                s1 = -s1
+            pauli_state = tf.stack([s0, s1], axis=qubit + 3)
+
+        axes = list(range(3, 3 + self.n_qubits))
+        output = tf.math.real(coefficient*tf.reduce_sum(tf.math.conj(state)*pauli_state, axis=axes))
+
+        # broadcast in case the state never depended on the data or on the kernel
+        return tf.broadcast_to(output, [tf.shape(input_data)[0], tf.shape(controller)[1], tf.shape(input_data)[1]])
+
+#######################
+# precompile the data independent parts of the circuit into dense unitaries
+#
+# for a fixed kernel every run of operations between two data encodings is the same for
+# every patch, so each run is multiplied into one [2^n, 2^n] unitary per kernel once per
+# call. Every row then only needs its single qubit rx encodings and one matrix-vector
+# product per run instead of replaying each parametrised gate.
+class Unitary_simulator(Statevector_simulator):
+
+    # initialize class
+    def __init__(self, circuit, input_params, learning_params, measurement):
+        super(Unitary_simulator, self).__init__(circuit, input_params, learning_params, measurement)
+
+        # split the operations into alternating blocks of data encodings and data independent operations
+        self.blocks = []
+        for operation in self.operations:
+            encodes_data = self.encodes_data(operation)
+            if self.blocks and self.blocks[-1][0] == encodes_data:
+                self.blocks[-1][1].append(operation)
+            else:
+                self.blocks.append((encodes_data, [operation]))
+
+    # build the unitary of a data independent block for every kernel, returned transposed
+    # with shape [n_groups, n_kernels, 2^n, 2^n] so that it right-multiplies row states
+    def get_unitary(self, operations, controller):
+        dim = 2**self.n_qubits
+        basis = tf.reshape(tf.eye(dim, dtype=tf.complex64), shape=[1, 1, dim] + [2]*self.n_qubits)
+        columns = self.apply_operations(basis, operations, None, controller)
+        return tf.reshape(columns, shape=tf.concat([tf.shape(columns)[:2], [dim, dim]], 0))
+
+    def apply_unitary(self, state, unitary):
+        dim = 2**self.n_qubits
+        state = tf.reshape(state, shape=tf.concat([tf.shape(state)[:3], [dim]], 0))
+        state = tf.linalg.matmul(state, unitary)
+        return tf.reshape(state, shape=tf.concat([tf.shape(state)[:3], [2]*self.n_qubits], 0))
+
+    def __call__(self, input_data, controller):
+        input_data = tf.cast(input_data, tf.float32)
+        controller = tf.cast(controller, tf.float32)
+
+        state = self.initial_state()
+        for encodes_data, operations in self.blocks:
+
+            # data encodings and blocks acting on the shared initial state are applied directly
+            if encodes_data or state.shape[2] == 1:
+                state = self.apply_operations(state, operations, input_data, controller)
+            else:
+                state = self.apply_unitary(state, self.get_unitary(operations, controller))
+
+        return self.expectation(state, input_data, controller)
+
+#######################
+# simulate the circuit as a matrix product state with a bounded bond dimension
+#
+# the qubits are laid out as a chain following the layers' register structure, every
+# ancilla directly followed by the 4 qubits of the register that deposits onto it, so
+# the ring of four inside a register and the deposit onto its ancilla stay within a few
+# sites. Controlled gates are applied exactly as bond dimension 2 operators across the
+# sites between control and target, then every grown bond is truncated to bond_dim.
+# The truncation subspace is taken from an SVD without gradient, so the result and its
+# gradients are exact while the entanglement fits in bond_dim and approximate otherwise.
+class Mps_simulator(Statevector_simulator):
+
+    # the sites are updated gate by gate
+    fuse_diagonal = False
+
+    # initialize class
+    def __init__(self, circuit, input_params, learning_params, measurement, bond_dim=16):
+        super(Mps_simulator, self).__init__(circuit, input_params, learning_params, measurement)
+        self.bond_dim = bond_dim
+
+    # place each ancilla (row 0) in front of the register (row i+1) that deposits onto it
+    def order_qubits(self, circuit):
+        qubits = sorted(circuit.all_qubits())
+        if not all(isinstance(q, cirq.GridQubit) for q in qubits):
+            return qubits
+
+        ancillas = [q for q in qubits if q.row == 0]
+        registers = sorted(set(q.row for q in qubits if q.row > 0))
+        order = []
+        for i, row in enumerate(registers):
+            if i < len(ancillas):
+                order.append(ancillas[i])
+            order += [q for q in qubits if q.row == row]
+        return order + [q for q in ancillas if q not in order]
+
+    # apply a 2x2 matrix, given as four broadcastable entries, to the physical index of a site
+    def apply_site(self, site, matrix):
+        m00, m01, m10, m11 = [m[..., None, None] for m in matrix]
+        s0, s1 = site[..., 0, :], site[..., 1, :]
+        return tf.stack([m00*s0 + m01*s1, m10*s0 + m11*s1], axis=-2)
+
+    # reshape the bond and physical indices of a site, keeping its batch dimensions
+    def reshape_site(self, site, n_batch_dims, shape):
+        return tf.reshape(site, shape=tf.concat([tf.shape(site)[:n_batch_dims], shape], 0))
+
+    # apply |0><0| x I + |1><1| x U as a bond dimension 2 operator between control and target,
+    # bonds holds the current bond dimensions with bonds[i] left of site i
+    def apply_controlled_sites(self, sites, bonds, control, target, matrix):
+        sites = list(sites)
+        bonds = list(bonds)
+        right = control < target
+        first, last = min(control, target), max(control, target)
+
+        # control site: the new index k selects the control state, site[..., l, s, r]*delta(s, k)
+        site = sites[control]
+        zero = tf.zeros_like(site[..., 0:1, :])
+        branches = [tf.concat([site[..., 0:1, :], zero], axis=-2), tf.concat([zero, site[..., 1:2, :]], axis=-2)]
+        if right:
+            sites[control] = self.reshape_site(tf.stack(branches, axis=-1), -4, [bonds[control], 2, bonds[control + 1]*2])
+        else:
+            sites[control] = self.reshape_site(tf.stack(branches, axis=-3), -4, [bonds[control]*2, 2, bonds[control + 1]])
+
+        # sites in between carry k through unchanged
+        for i in range(first + 1, last):
+            site = tf.einsum('...lsr,kj->...lksrj', sites[i], tf.eye(2, dtype=tf.complex64))
+            sites[i] = self.reshape_site(site, -5, [bonds[i]*2, 2, bonds[i + 1]*2])
+
+        # target site: identity for k = 0 and U for k = 1
+        site = sites[target]
+        branches = [site, self.apply_site(site, matrix)]
+        shape = tf.broadcast_dynamic_shape(tf.shape(branches[0]), tf.shape(branches[1]))
+        branches = [tf.broadcast_to(b, shape) for b in branches]
+        if right:
+            sites[target] = self.reshape_site(tf.stack(branches, axis=-3), -4, [bonds[target]*2, 2, bonds[target + 1]])
+        else:
+            sites[target] = self.reshape_site(tf.stack(branches, axis=-1), -4, [bonds[target], 2, bonds[target + 1]*2])
+
+        for i in range(first + 1, last + 1):
+            bonds[i] = bonds[i]*2
+
+        # truncate the grown bonds
+        for i in range(first, last):
+            sites, bonds = self.truncate(sites, bonds, i)
+        return sites, bonds
+
+    # recompress the bond right of site i from the two site tensor theta, while min(rows, cols)
+    # fits bond_dim theta is kept whole on the smaller side which is exact and differentiable,
+    # otherwise only the leading singular vectors are kept
+    def truncate(self, sites, bonds, i):
+        rows, cols = bonds[i]*2, 2*bonds[i + 2]
+        if bonds[i + 1] <= min(rows, cols, self.bond_dim):
+            return sites, bonds
+
+        theta = tf.einsum('...lsr,...rtm->...lstm', sites[i], sites[i + 1])
+        theta = self.reshape_site(theta, -4, [rows, cols])
+        sites = list(sites)
+        bonds = list(bonds)
+
+        if rows <= min(cols, self.bond_dim):
+            sites[i] = tf.reshape(tf.eye(rows, dtype=tf.complex64), [1, 1, 1, bonds[i], 2, rows])
+            sites[i + 1] = self.reshape_site(theta, -2, [rows, 2, bonds[i + 2]])
+            bonds[i + 1] = rows
+        elif cols <= self.bond_dim:
+            sites[i] = self.reshape_site(theta, -2, [bonds[i], 2, cols])
+            sites[i + 1] = tf.reshape(tf.eye(cols, dtype=tf.complex64), [1, 1, 1, cols, 2, bonds[i + 2]])
+            bonds[i + 1] = cols
+        else:
+            # the kept subspace is chosen without gradient since the svd gradient is unstable
+            # for degenerate singular values, gradients are approximate like the state itself
+            _, u, _ = tf.linalg.svd(tf.stop_gradient(theta), full_matrices=False)
+            u = u[..., :self.bond_dim]
+            sites[i] = self.reshape_site(u, -2, [bonds[i], 2, self.bond_dim])
+            sites[i + 1] = self.reshape_site(tf.linalg.matmul(u, theta, adjoint_a=True), -2, [self.bond_dim, 2, bonds[i + 2]])
+            bonds[i + 1] = self.bond_dim
+        return sites, bonds
+
+    def __call__(self, input_data, controller):
+        input_data = tf.cast(input_data, tf.float32)
+        controller = tf.cast(controller, tf.float32)
+
+        # initialize every site to |0> with shape [1, 1, 1, 1, 2, 1]
+        sites = [tf.constant([1, 0], shape=[1, 1, 1, 1, 2, 1], dtype=tf.complex64)]*self.n_qubits
+        bonds = [1]*(self.n_qubits + 1)
+
+        for kind, qubits, exponent in self.operations:
+            if kind == "H":
+                h = tf.constant(1/np.sqrt(2), shape=[1, 1, 1], dtype=tf.complex64)
+                sites[qubits[0]] = self.apply_site(sites[qubits[0]], (h, h, h, -h))
+                continue
+
+            t = self.get_exponent(exponent, input_data, controller)
+            if kind == "X":
+                sites[qubits[0]] = self.apply_site(sites[qubits[0]], self.x_pow(t))
+            elif kind == "Z":
+                sites[qubits[0]] = self.apply_site(sites[qubits[0]], self.z_pow(t))
+            elif kind == "CX":
+                sites, bonds = self.apply_controlled_sites(sites, bonds, qubits[0], qubits[1], self.x_pow(t))
+            elif kind == "CZ":
+                sites, bonds = self.apply_controlled_sites(sites, bonds, qubits[0], qubits[1], self.z_pow(t))
+
+        return self.expectation(sites, input_data, controller)
+
+    # contract <psi|P|psi> from left to right
+    def expectation(self, sites, input_data, controller):
+        coefficient, paulis = self.observable
+        paulis = dict(paulis)
+        matrices = {"X": [[0, 1], [1, 0]], "Y": [[0, -1j], [1j, 0]], "Z": [[1, 0], [0, -1]]}
+
+        environment = tf.ones([1, 1, 1, 1, 1], dtype=tf.complex64)
+        for i, site in enumerate(sites):
+            pauli = tf.constant(matrices.get(paulis.get(i), [[1, 0], [0, 1]]), dtype=tf.complex64)
+            environment = tf.einsum('...xy,...xtc,ts,...ysd->...cd', environment, tf.math.conj(site), pauli, site)
+
+        output = tf.math.real(coefficient*environment[..., 0, 0])
+        return tf.broadcast_to(output, [tf.shape(input_data)[0], tf.shape(controller)[1], tf.shape(input_data)[1]])
+
+#######################
+# split the rows of every call across several tensorflow devices and gather the expectations
+# back, each shard is an ordinary differentiable call of the wrapped simulator so gradients
+# flow through unchanged and the shards are free to run concurrently
+class Sharded_simulator:
+
+    # initialize class, devices is a list of device names or the number of local devices to use
+    def __init__(self, simulator, devices):
+        if isinstance(devices, int):
+            devices = get_devices(devices)
+        self.simulator = simulator
+        self.devices = list(devices)
+
+    def __call__(self, input_data, controller):
+        n_rows = tf.shape(input_data)[1]
+        n_shards = len(self.devices)
+
+        outputs = []
+        for i, device in enumerate(self.devices):
+            start = n_rows*i//n_shards
+            end = n_rows*(i + 1)//n_shards
+            with tf.device(device):
+                outputs.append(self.simulator(input_data[:, start:end], controller))
+        return tf.concat(outputs, axis=2)
+
+# return the names of the first n_devices local devices, accelerators are preferred over cpus
+def get_devices(n_devices):
+    devices = tf.config.list_logical_devices('GPU') or tf.config.list_logical_devices('CPU')
+    if len(devices) < n_devices:
+        raise ValueError("Requested "+str(n_devices)+" devices but only "+str(len(devices))+" are available, call configure_cpu_devices before building the model")
+    return [d.name for d in devices[:n_devices]]
+
+# split the physical cpu into n_devices logical devices so the shards of a sharded simulator
+# are placed on separate devices, must be called before tensorflow is initialized
+def configure_cpu_devices(n_devices, threads_per_device=None):
+    cpu = tf.config.list_physical_devices('CPU')[0]
+    tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()]*n_devices)
+    if threads_per_device is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(n_devices)
+        tf.config.threading.set_intra_op_parallelism_threads(threads_per_device)
+    return get_devices(n_devices)
+
+#######################
+# available simulation backends
+simulators = {"tfq": TFQ_simulator,
+              "statevector": Statevector_simulator,
+              "unitary": Unitary_simulator,
+              "closed_form": Closed_form_simulator,
+              "mps": Mps_simulator}
+
+# create the simulator used by a quantum layer, backend_options are passed on to the
+# simulator, e.g. {"bond_dim": 32} for the "mps" backend, and devices shards every call
+# across the given devices (a list of names or a number of local devices)
+def get_simulator(backend, circuit, input_params, learning_params, measurement, backend_options=None, devices=None):
+    if backend not in simulators:
+        raise ValueError("Unknown backend "+str(backend)+", choose one of "+str(list(simulators)))
+    simulator = simulators[backend](circuit, input_params, learning_params, measurement, **(backend_options or {}))
+    if devices:
+        simulator = Sharded_simulator(simulator, devices)
+    return simulator
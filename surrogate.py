@@ -0,0 +1,196 @@
+# import packages
+import argparse
+import json
+import os
+import time
+import tensorflow as tf
+import numpy as np
+
+# import project functions, importing circuits registers the quantum layers for load_model
+import circuits
+from simulators import Statevector_simulator
+
+#######################
+# classical surrogates of the trained kernels of a quantum layer for inference
+#
+# every data value x enters the circuits through gates X**(c*x), Z**(c*x) or their controlled
+# versions, and the expectation value of a gate with exponent c*x only contains the frequencies
+# 0 and c of pi*x. with a fixed kernel the expectation value of a patch is therefore exactly a
+# trigonometric polynomial in the patch values whose frequency in each value is the sum of its
+# coefficients. the polynomial is found exactly with a fast fourier transform of the expectation
+# values on a grid of 2F+1 points per value, then the smallest coefficients are dropped while
+# their total stays below the error bound. since every term is at most 1 in absolute value, the
+# surrogate is never further than the error bound from the exact expectation value
+#
+# a surrogate evaluates cos and sin of pi*m.x for its frequency vectors m and a small matrix
+# product per row instead of simulating the circuit. the grid has prod(2F+1) points, 81 for
+# Q_U1_control and 3**12 for the U1 layers on 3 channels
+
+# largest grid that is simulated to fit a surrogate
+max_grid_points = 3**12
+
+# rows simulated per call while fitting and validating
+chunk_size = 2**15
+
+# most terms of a surrogate, the cost of a surrogate grows with its terms and beyond a few
+# thousand it is slower than simulating the circuit
+max_terms = 2**14
+
+# the frequency of each data value in the circuit, the coefficients of the data values must be
+# integers so the expectation value is periodic on [0, 2)
+def input_frequencies(simulator, n_inputs):
+    frequencies = np.zeros(n_inputs)
+    for kind, _, exponent in simulator.operations:
+        for e in ([e for _, e in exponent] if kind == "DIAG" else [exponent]):
+            if not isinstance(e, float) and e[0] == "input":
+                frequencies[e[1]] += abs(e[2])
+    if np.any(np.abs(frequencies - np.round(frequencies)) > 1e-6):
+        raise ValueError("Data values must enter the circuit with integer coefficients, got frequencies "+str(frequencies))
+    return np.round(frequencies).astype(int)
+
+# evaluate the exact expectation values of rows x [n_rows, n_inputs] for every group and kernel
+def simulate(simulator, x, controller):
+    n_groups = controller.shape[0]
+    outputs = []
+    for i in range(0, len(x), chunk_size):
+        rows = tf.constant(np.broadcast_to(x[None, i:i+chunk_size], (n_groups,) + x[i:i+chunk_size].shape), dtype=tf.float32)
+        outputs.append(simulator(rows, controller).numpy().astype(np.float64))
+    return np.concatenate(outputs, axis=2)
+
+#############################
+# a surrogate of the kernels of a layer, frequencies [n_terms, n_inputs] are the frequency vectors
+# m of the terms, the expectation value of group g and kernel k is
+# constant[g, k] + sum_t cosines[g, k, t]*cos(pi*m_t.x) + sines[g, k, t]*sin(pi*m_t.x)
+class Fourier_surrogate:
+
+    # initialize class, kernel are the values of the layer kernel the surrogate was fitted for
+    def __init__(self, frequencies, constant, cosines, sines, kernel, report=None):
+        self.frequencies = np.asarray(frequencies, dtype=np.float32)
+        self.constant = np.asarray(constant, dtype=np.float32)
+        self.cosines = np.asarray(cosines, dtype=np.float32)
+        self.sines = np.asarray(sines, dtype=np.float32)
+        self.kernel = np.asarray(kernel, dtype=np.float32)
+        self.report = report or {}
+
+    @property
+    def n_terms(self):
+        return len(self.frequencies)
+
+    # see simulators.py for the shapes, the controller is only checked against the fitted kernel
+    def __call__(self, input_data, controller):
+        tf.debugging.assert_near(controller, tf.transpose(self.kernel, perm=[1, 0, 2]), rtol=0.0, atol=1e-6,
+                                 message="The kernel changed since the surrogate was fitted, fit it again")
+        angles = np.pi*tf.einsum('grd,td->grt', tf.cast(input_data, tf.float32), self.frequencies)
+        output = tf.einsum('gkt,grt->gkr', self.cosines, tf.cos(angles)) + tf.einsum('gkt,grt->gkr', self.sines, tf.sin(angles))
+        return output + self.constant[:, :, None]
+
+    def save(self, path):
+        np.savez_compressed(path, frequencies=self.frequencies, constant=self.constant, cosines=self.cosines, sines=self.sines,
+                            kernel=self.kernel, report=np.array(json.dumps(self.report)))
+
+def load_surrogate(path):
+    with np.load(path, allow_pickle=False) as data:
+        return Fourier_surrogate(data["frequencies"], data["constant"], data["cosines"], data["sines"], data["kernel"], json.loads(str(data["report"])))
+
+#############################
+# fit the surrogate of the kernels of a built layer, with terms dropped while their total is
+# below error_bound, and validate it against the exact simulation on n_validation random patches
+def fit_surrogate(layer, error_bound=1e-3, n_validation=4096, seed=0):
+    n_inputs = len(layer.input_params)
+    simulator = Statevector_simulator(layer.compiled_circuit, layer.input_params, layer.learning_params, layer.measurement)
+    frequencies = input_frequencies(simulator, n_inputs)
+    points = 2*frequencies + 1
+    if np.prod(points) > max_grid_points:
+        raise ValueError("A surrogate of "+layer.name+" needs "+str(np.prod(points))+" grid points, more than max_grid_points="+str(max_grid_points))
+
+    # expectation values on the grid x_i = 2*j/(2F_i+1), which samples every period exactly
+    kernel = layer.kernel.numpy()
+    controller = tf.constant(np.transpose(kernel, [1, 0, 2]))
+    start = time.perf_counter()
+    grid = np.stack(np.meshgrid(*[2*np.arange(n)/n for n in points], indexing='ij'), axis=-1).reshape(-1, n_inputs)
+    values = simulate(simulator, grid, controller)
+    n_groups, n_kernels = values.shape[:2]
+    coefficients = np.fft.fftn(values.reshape([n_groups, n_kernels] + list(points)), axes=range(2, 2 + n_inputs)) / np.prod(points)
+
+    # frequency vectors of the fft bins, the expectation value is real so a term and its negative
+    # are combined and only vectors whose first nonzero frequency is positive are kept
+    indices = np.stack(np.meshgrid(*[np.arange(n) for n in points], indexing='ij'), axis=-1).reshape(-1, n_inputs)
+    vectors = np.where(indices > frequencies, indices - points, indices)
+    coefficients = coefficients.reshape(n_groups, n_kernels, -1)
+    first = vectors[np.arange(len(vectors)), np.argmax(vectors != 0, axis=1)]
+    constant = coefficients[:, :, first == 0].real[:, :, 0]
+    vectors, coefficients = vectors[first > 0], 2*coefficients[:, :, first > 0]
+
+    # drop the smallest terms of every kernel while their total magnitude stays below the bound
+    magnitudes = np.abs(coefficients)
+    keep = np.zeros(magnitudes.shape, dtype=bool)
+    bounds = np.zeros([n_groups, n_kernels])
+    for g in range(n_groups):
+        for k in range(n_kernels):
+            order = np.argsort(magnitudes[g, k])
+            dropped = np.cumsum(magnitudes[g, k, order]) <= error_bound
+            keep[g, k, order[~dropped]] = True
+            bounds[g, k] = magnitudes[g, k, order[dropped]].sum()
+    coefficients = np.where(keep, coefficients, 0)
+    used = keep.any(axis=(0, 1))
+    fit_seconds = time.perf_counter() - start
+    if used.sum() > max_terms:
+        raise ValueError("The surrogate of "+layer.name+" needs "+str(used.sum())+" terms for an error bound of "+str(error_bound)+", more than max_terms="+str(max_terms))
+
+    # cos(pi*m.x) has the real part and sin(pi*m.x) the negative imaginary part as coefficient
+    surrogate = Fourier_surrogate(vectors[used], constant, coefficients[:, :, used].real, -coefficients[:, :, used].imag, kernel)
+    surrogate.report = dict(validate(surrogate, simulator, controller, n_inputs, n_validation, seed),
+                            layer=layer.name,
+                            error_bound=error_bound,
+                            grid_points=int(np.prod(points)),
+                            max_frequencies=frequencies.tolist(),
+                            terms=int(surrogate.n_terms),
+                            terms_per_kernel=keep.sum(axis=2).tolist(),
+                            dropped_magnitude=bounds.tolist(),
+                            fit_seconds=fit_seconds)
+    return surrogate
+
+# max and mean error of a surrogate against the exact simulation on random patches in [0, 1], with
+# the time per patch of both
+def validate(surrogate, simulator, controller, n_inputs, n_validation, seed=0):
+    if not n_validation:
+        return {}
+    x = np.random.default_rng(seed).random((n_validation, n_inputs))
+    start = time.perf_counter()
+    exact = simulate(simulator, x, controller)
+    simulation_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    approximation = np.concatenate([surrogate(tf.constant(np.broadcast_to(x[None, i:i+chunk_size], (controller.shape[0],) + x[i:i+chunk_size].shape), dtype=tf.float32), controller).numpy()
+                                    for i in range(0, len(x), chunk_size)], axis=2)
+    surrogate_seconds = time.perf_counter() - start
+    error = np.abs(approximation - exact)
+    return {"validation_patches": n_validation,
+            "max_error": float(error.max()),
+            "mean_error": float(error.mean()),
+            "max_error_per_kernel": error.max(axis=2).tolist(),
+            "simulation_seconds": simulation_seconds,
+            "surrogate_seconds": surrogate_seconds}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit surrogates for the kernels of the quantum layer of a trained model.")
+    parser.add_argument("model", help="model saved by train.py, e.g. output/<time>_<model>/model.keras")
+    parser.add_argument("--output", help="surrogate file (default model_surrogate.npz next to the model)")
+    parser.add_argument("--error-bound", type=float, default=1e-3, help="largest difference to the exact expectation values")
+    parser.add_argument("--validate", type=int, default=4096, help="random patches the surrogate is validated on")
+    args = parser.parse_args()
+
+    model = tf.keras.models.load_model(args.model)
+    layer = [layer for layer in model.layers if hasattr(layer, 'compiled_circuit')][0]
+    surrogate = fit_surrogate(layer, args.error_bound, args.validate)
+    output = args.output or os.path.join(os.path.dirname(args.model), 'model_surrogate.npz')
+    surrogate.save(output)
+    with open(os.path.splitext(output)[0]+'_report.json', 'w') as f:
+        json.dump(surrogate.report, f, indent=2)
+
+    report = surrogate.report
+    print("Surrogate of "+layer.name+" written to "+output+": "+str(report["terms"])+" terms from "+str(report["grid_points"])+" grid points")
+    if "max_error" in report:
+        print("Validation on "+str(report["validation_patches"])+" patches: max error "+str(report["max_error"])+", mean error "+str(report["mean_error"])+
+              ", "+str(round(report["simulation_seconds"]/report["surrogate_seconds"], 1))+"x faster than simulation")
+        if report["surrogate_seconds"] > report["simulation_seconds"]:
+            print("Warning: the surrogate is slower than simulating "+layer.name+", raise the error bound or keep simulating")
@@ -0,0 +1,200 @@
+# import packages
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import tensorflow as tf
+import numpy as np
+
+# import project functions
+from prepare_data import datasize
+from train import build_model, defaults, setup_worker, load_model_data
+
+#######################
+# hyperparameter sweep over the model builders with asynchronous successive halving
+#
+# trials are drawn from a search space (every combination of a grid or random samples) and
+# trained on a pool of worker processes. the epochs min_epochs, min_epochs*eta, min_epochs*eta^2, ...
+# below max_epochs are rungs, when a trial reaches a rung its validation metric is compared with
+# the metrics the other trials recorded at that rung so far and the trial is terminated unless it
+# is in the top 1/eta of them. trials never wait for each other, so the workers stay busy and poor
+# trials only cost a few epochs
+
+# settings of the scheduler
+sweep_defaults = {"strategy": "grid",
+                  "trials": 10,
+                  "min_epochs": 1,
+                  "max_epochs": 9,
+                  "reduction_factor": 3,
+                  "metric": "val_accuracy",
+                  "workers": 1,
+                  "threads_per_worker": None,
+                  "seed": 0}
+
+#############################
+# epochs at which the trials are compared
+def get_rungs(min_epochs, max_epochs, reduction_factor):
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= reduction_factor
+    return rungs
+
+# draw one value of a search space entry, lists are sampled uniformly and
+# {"uniform": [a, b]}, {"log_uniform": [a, b]} or {"int": [a, b]} from the range
+def sample_value(value, rng):
+    if isinstance(value, list):
+        return value[rng.integers(len(value))]
+    if isinstance(value, dict):
+        (kind, (low, high)), = value.items()
+        if kind == "uniform":
+            return float(rng.uniform(low, high))
+        if kind == "log_uniform":
+            return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        if kind == "int":
+            return int(rng.integers(low, high + 1))
+        raise ValueError("Unknown distribution "+kind+", choose from uniform, log_uniform, int")
+    return value
+
+# settings of train.py a trial does not use, the scheduler sets the epochs, trials train on the
+# in memory data without the feature store and are neither checkpointed nor profiled
+trial_ignored_settings = ["epochs", "freeze_quantum", "stream_data", "checkpoint_every", "resume", "overwrite", "profile", "trace"]
+
+# the runs of the trials of a search space, every setting not in the space is taken from train.py
+def get_trials(space, strategy, n_trials, seed):
+    ignored = [k for k in space if k in trial_ignored_settings]
+    if ignored:
+        raise ValueError("The search space settings "+str(ignored)+" are not supported by sweeps, trials do not use "+str(trial_ignored_settings))
+    unknown = [k for k in space if k not in defaults]
+    if unknown:
+        raise ValueError("Unknown search space settings "+str(unknown)+", choose from "+str([k for k in defaults if k not in trial_ignored_settings]))
+
+    if strategy == "grid":
+        ranges = [k for k, v in space.items() if isinstance(v, dict)]
+        if ranges:
+            raise ValueError("Grid search needs lists of values, "+str(ranges)+" are ranges")
+        axes = [v if isinstance(v, list) else [v] for v in space.values()]
+        trials = [dict(zip(space.keys(), values)) for values in itertools.product(*axes)]
+    elif strategy == "random":
+        rng = np.random.default_rng(seed)
+        trials = [{k: sample_value(v, rng) for k, v in space.items()} for _ in range(n_trials)]
+    else:
+        raise ValueError("Unknown strategy "+strategy+", choose from grid, random")
+    return [dict(defaults, **trial) for trial in trials]
+
+#############################
+# records the metric of a trial at every rung and stops the training of poor trials
+class Successive_halving(tf.keras.callbacks.Callback):
+
+    # initialize class, rung_results is a dict shared between the workers and lock guards it
+    def __init__(self, rungs, reduction_factor, metric, rung_results, lock):
+        super().__init__()
+        self.rungs = rungs
+        self.reduction_factor = reduction_factor
+        self.metric = metric
+        self.rung_results = rung_results
+        self.lock = lock
+        self.terminated_at = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        epochs = epoch + 1
+        if epochs not in self.rungs:
+            return
+
+        # losses are minimized, everything else is maximized
+        value = logs[self.metric]
+        score = -value if "loss" in self.metric else value
+        with self.lock:
+            recorded = self.rung_results.get(epochs, [])
+            cutoff = np.percentile(recorded, 100*(1 - 1/self.reduction_factor)) if recorded else None
+            self.rung_results[epochs] = recorded + [score]
+
+        if cutoff is not None and score < cutoff:
+            print("Terminating trial at epoch "+str(epochs)+": "+self.metric+"="+str(round(value, 4)))
+            self.terminated_at = epochs
+            self.model.stop_training = True
+
+# train one trial until it is terminated or reaches max_epochs, returns a summary of the trial
+def run_trial(trial, index, sweep, rung_results, lock):
+    setup_worker(sweep["threads_per_worker"], trial["devices"])
+    tf.keras.utils.set_random_seed(trial["seed"])
+    datatype = trial["dataset"]
+    details = [datasize(datatype,trial["classes"],trial["samples"])[0],trial["image_size"],trial["image_size"],trial["learning_rate"],trial["batch_size"],datasize(datatype,trial["classes"],trial["samples"])[1],datatype,sweep["max_epochs"]]
+
+    model = build_model(trial)
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=trial["learning_rate"]), loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+    model_data = load_model_data(model,trial,details)
+
+    scheduler = Successive_halving(get_rungs(sweep["min_epochs"], sweep["max_epochs"], sweep["reduction_factor"]), sweep["reduction_factor"], sweep["metric"], rung_results, lock)
+    start = time.time()
+    model_history = model.fit(model_data[0], model_data[2], validation_data=(model_data[1],model_data[3]), epochs=sweep["max_epochs"], batch_size=trial["batch_size"], callbacks=[scheduler], verbose=2)
+
+    values = model_history.history[sweep["metric"]]
+    best = min(values) if "loss" in sweep["metric"] else max(values)
+    return dict(trial, trial=index, epochs=len(values), status="terminated" if scheduler.terminated_at else "completed",
+                **{sweep["metric"]: values[-1], "best_"+sweep["metric"]: best}, seconds=round(time.time() - start, 1))
+
+#############################
+# run a sweep, space maps settings of train.py to lists of values or ranges
+def run_sweep(space, **settings):
+    unknown = [k for k in settings if k not in sweep_defaults]
+    if unknown:
+        raise ValueError("Unknown sweep settings "+str(unknown)+", choose from "+str(list(sweep_defaults)))
+    sweep = dict(sweep_defaults, **settings)
+    trials = get_trials(space, sweep["strategy"], sweep["trials"], sweep["seed"])
+    print("Sweeping "+str(len(trials))+" trials on "+str(sweep["workers"])+" worker(s), rungs at epochs "+
+          str(get_rungs(sweep["min_epochs"], sweep["max_epochs"], sweep["reduction_factor"])))
+
+    # the rung results are shared between the worker processes through a manager
+    # tensorflow is not fork safe, workers are started as fresh processes
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        rung_results, lock = manager.dict(), manager.Lock()
+        if sweep["workers"] <= 1:
+            results = [run_trial(trial, i, sweep, rung_results, lock) for i, trial in enumerate(trials)]
+        else:
+            with ProcessPoolExecutor(max_workers=sweep["workers"], mp_context=context) as pool:
+                futures = [pool.submit(run_trial, trial, i, sweep, rung_results, lock) for i, trial in enumerate(trials)]
+                results = [future.result() for future in futures]
+
+    # write the results, best trial first
+    results.sort(key=lambda r: r["best_"+sweep["metric"]], reverse="loss" not in sweep["metric"])
+    os.makedirs('output', exist_ok=True)
+    path = 'output/'+time.strftime("%Y%m%d-%H%M%S")+'_sweep.json'
+    with open(path, 'w') as f:
+        json.dump({"space": space, "settings": sweep, "results": results}, f, indent=2)
+
+    print("~~~~~~~~~~~RESULTS~~~~~~~~~~")
+    for result in results:
+        print("trial "+str(result["trial"])+" "+", ".join(k+"="+str(result[k]) for k in space)+
+              ": best "+sweep["metric"]+"="+str(round(result["best_"+sweep["metric"]],4))+" after "+str(result["epochs"])+" epochs ("+result["status"]+")")
+    print("Results written to "+path)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep over the QCNN models with successive halving.")
+    parser.add_argument("--config", help='json file with a "space" of settings and optionally the sweep settings')
+    parser.add_argument("--strategy", choices=["grid", "random"])
+    parser.add_argument("--trials", type=int, help="number of random trials")
+    parser.add_argument("--min-epochs", type=int, help="epochs before the first comparison")
+    parser.add_argument("--max-epochs", type=int, help="epochs of trials that are never terminated")
+    parser.add_argument("--reduction-factor", type=int, help="only the top 1/reduction_factor of a rung continue")
+    parser.add_argument("--metric", help="validation metric reported by model.fit, losses are minimized")
+    parser.add_argument("--workers", type=int, help="number of trials trained at the same time")
+    parser.add_argument("--threads-per-worker", type=int, help="tensorflow threads of every worker")
+    parser.add_argument("--seed", type=int, help="seed of the random search")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    space = config.pop("space", {})
+    for key, value in vars(args).items():
+        if key != "config" and value is not None:
+            config[key] = value
+    run_sweep(space, **config)
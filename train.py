@@ -1,4 +1,11 @@
 # import packages
+import argparse
+import itertools
+import json
+import multiprocessing
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import tensorflow as tf
 from sklearn.metrics import confusion_matrix
 import matplotlib.pyplot as plt
@@ -7,142 +14,206 @@ from tensorflow.keras.utils import plot_model
 import numpy as np
 import os
 
-if not os.path.exists('output'):
-    os.makedirs('output')
+# import project functions
+from prepare_data import datasize, build_model_datasets, build_streaming_datasets, build_channels_datasets
+import generate_output
+import models
+import feature_store
+import checkpoints
+import profiling
+from expectation_cache import hit_rates
+from utils import normalize_channels, normalized_datatypes, compute_channel_stats, compute_dataset_channel_stats
+from simulators import configure_cpu_devices, get_devices
 
-print("~~~~~~~~~~~MENU~~~~~~~~~~~~~")
-print("1: COLORS")
-print("2: COLORS_SHAPE")
-print("3: CIFAR-10")
-print("Note: Run create_noisy_colors.py first if you want to check with synthetic data too.")
-try:
-    datamenu1 = int(input('Choose dataset to train on (enter number): '))
-except:
-    datamenu1 = 3
+# model builders by name, the names are used in config files and on the command line
+model_builders = {"CO": models.CO_U1_QCNN_model,
+                  "WEV": models.QCNN_U1_weighted_control_model,
+                  "control": models.QCNN_U1_control_model,
+                  "modified_CO": models.MODIFIED_CO_U1_QCNN_model}
 
-try:
-    datamenu2 = float(input('Enter learning rate (default 0.001): '))
-except:
-    datamenu2 = 0.001
+# settings of a single training run, every setting of a config can also be given as a list in
+# which case one run is made for every combination
+defaults = {"dataset": "CIFAR10",
+            "classes": 10,
+            "learning_rate": 0.001,
+            "epochs": 10,
+            "batch_size": 50,
+            "image_size": 10,
+            "model": "CO",
+            "backend": "tfq",
+            "bond_dim": None,
+            "fused_kernels": False,
+            "devices": None,
+            "cache_size": None,
+            "normalization": "dataset",
+            "freeze_quantum": False,
+            "stream_data": False,
+            "channels": 12,
+            "samples": None,
+            "seed": 42,
+            "checkpoint_every": 1,
+            "resume": False,
+            "overwrite": False,
+            "profile": False,
+            "trace": False}
 
-if datamenu2 == '':
-    datamenu2 = 0.001
+# settings of the process pool
+pool_defaults = {"workers": 1,
+                 "threads_per_worker": None}
 
-if datamenu1 == 3:
-    try:
-        datamenu3 = int(input('Enter number of CIFAR classes (default 10): '))
-    except:
-        datamenu3 = 10
-    
-    if datamenu3 == '':
-        datamenu3 = 10
-else:
-    datamenu3 = 10
-    
-print("Select models to run sequentially (y/n): ")
-
-model1 = input('CO-QCNN (U1): ')
-model2 = input('WEV-QCNN (U1): ')
-model3 = input('Control QCNN (U1): ')
-model4 = input('Modified CO-QCNN (U1): ')
-
-print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-# choose dataset to train on
-
-if datamenu1 == 1: 
-    datatype = "COLORS"
-if datamenu1 == 2: 
-    datatype = "COLORS_SHAPE"
-if datamenu1 == 3: 
-    datatype = "CIFAR10"
-    
-
-# choose hyperparameters
-num_of_epochs = 10
-global_learning_rate = datamenu2
-global_batch_size = 50
-
-#classes of CIFAR-10 dataset
-classes = datamenu3
-
-# choose image size
-resize_x = 10 
-resize_y = 10 
+#############################
+# expand a config into the list of runs, every list valued setting is a grid axis
+def expand_config(config):
+    config = dict(defaults, **{k: v for k, v in config.items() if k not in pool_defaults})
+    unknown = [k for k in config if k not in defaults]
+    if unknown:
+        raise ValueError("Unknown settings "+str(unknown)+", choose from "+str(list(defaults)+list(pool_defaults)))
 
-# import project functions
-from prepare_data import datasize, build_model_datasets
-import generate_output
-import models
+    axes = [v if isinstance(v, list) else [v] for v in config.values()]
+    return [dict(zip(config.keys(), values)) for values in itertools.product(*axes)]
 
-# list containing train size, image size x, image size y, learning_rate, batch size, test size, dataset, number of epochs
-details = [datasize(datatype,classes)[0],resize_x,resize_y,global_learning_rate,global_batch_size,datasize(datatype,classes)[1],datatype,num_of_epochs]
+# limit the threads tensorflow uses in this process, must be called before tensorflow runs an op
+def set_threads(threads):
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(min(threads, 2))
 
-# set model to True to run
-############################
-if model1 == "y":
-    CO_U1_QCNN = True 
-else:
-    CO_U1_QCNN = False 
-    
-if model2 == "y":
-    WEV_U1_QCNN = True 
-else:
-    WEV_U1_QCNN = False 
-    
-if model3 == "y":
-    control_U1_QCNN = True 
-else:
-    control_U1_QCNN = False
-if model4 == "y":
-    MODIFIED_CO_U1_QCNN = True 
-else:
-    MODIFIED_CO_U1_QCNN = False  
-
-        
+# prepare the tensorflow of a worker process before it runs an op, with n_devices the cpu is split
+# into logical devices that the simulators shard the circuits across. the devices can only be
+# configured once per process, later runs of the process reuse them
+def setup_worker(threads, n_devices=None):
+    set_threads(threads)
+    if n_devices and not tf.config.list_physical_devices('GPU'):
+        try:
+            configure_cpu_devices(n_devices, threads)
+        except RuntimeError:
+            get_devices(n_devices)
 
-#############################
-models_to_train = []
-#############################
-if CO_U1_QCNN:
-    models_to_train.append(models.CO_U1_QCNN_model(datatype,classes))
+# how train.py normalizes the channels of the color datasets, 'dataset' and 'sample' normalize
+# once in the input pipeline with the statistics of the training split or of every image, 'batch'
+# leaves it to the quantum layer. per image statistics can lose the intensity of the colors
+normalization_modes = {"dataset": "pipeline", "sample": "pipeline", "batch": "batch"}
 
-if WEV_U1_QCNN:
-    models_to_train.append(models.QCNN_U1_weighted_control_model(datatype,classes))
+# the quantum layer of a model if its inputs are normalized in the input pipeline
+def pipeline_normalized_layer(model, datatype):
+    quantum_layer = [layer for layer in model.layers if hasattr(layer, 'normalizes_inputs')][0]
+    if quantum_layer.normalizes_inputs and quantum_layer.normalization == 'pipeline' and datatype in normalized_datatypes:
+        return quantum_layer
+    return None
 
-if control_U1_QCNN:
-    models_to_train.append(models.QCNN_U1_control_model(datatype,classes))
+# load the in memory train/test data of a run for a model, the channels are normalized once
+# here if the quantum layer of the model expects them normalized. the statistics of the training
+# split are kept in the layer, so they are saved with the model
+def load_model_data(model,run,details):
+    datatype = run["dataset"]
+    model_data = build_model_datasets(datatype,details,run["classes"],run["seed"],run["channels"],run["samples"])
+    quantum_layer = pipeline_normalized_layer(model, datatype)
+    if quantum_layer is not None:
+        stats = compute_channel_stats(model_data[0]) if run["normalization"] == "dataset" else None
+        if stats is not None:
+            quantum_layer.channel_stats = [stats[0].tolist(), stats[1].tolist()]
+        model_data = [np.asarray(normalize_channels(model_data[0],datatype,stats)), np.asarray(normalize_channels(model_data[1],datatype,stats))] + list(model_data[2:])
+    return model_data
 
-if MODIFIED_CO_U1_QCNN:
-    models_to_train.append(models.MODIFIED_CO_U1_QCNN_model(datatype,classes))
-      
 #############################
 
-def train_model(model_to_train,classes):
+def train_model(model_to_train,run):
     model = model_to_train
+    datatype = run["dataset"]
+    classes = run["classes"]
+    global_learning_rate = run["learning_rate"]
+    global_batch_size = run["batch_size"]
+    num_of_epochs = run["epochs"]
+    freeze_quantum = run["freeze_quantum"]
+    stream_data = run["stream_data"]
+
+    # the feature store needs the images in memory, the synthetic image folders are streamed from
+    # disk and the CHANNELS data is generated batch by batch
+    if stream_data and (freeze_quantum or datatype not in ["COLORS", "COLORS_SHAPE", "CHANNELS"]):
+        print("Streaming is only used for COLORS, COLORS_SHAPE and CHANNELS without the feature store")
+        stream_data = False
+
+# list containing train size, image size x, image size y, learning_rate, batch size, test size, dataset, number of epochs
+    details = [datasize(datatype,classes,run["samples"])[0],run["image_size"],run["image_size"],global_learning_rate,global_batch_size,datasize(datatype,classes,run["samples"])[1],datatype,num_of_epochs]
 ##########################
 # print the architecture of the model
     model.summary()
 ############################
-# grab the time the training starts, output folder will be named with this time
-    timestr_ = time.strftime("%Y%m%d-%H%M%S")
+# grab the time the training starts, output folder will be named with this time and the model
+    timestr_ = time.strftime("%Y%m%d-%H%M%S")+'_'+model.name
 # compile model
-    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=global_learning_rate), loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+    optimizer = tf.keras.optimizers.Adam(learning_rate=global_learning_rate)
+    model.compile(optimizer=optimizer, loss='sparse_categorical_crossentropy', metrics=['accuracy'])
 # preprocess the chosen dataset
-    model_data = build_model_datasets(datatype,details,classes)
+# normalize the channels of every image once in the input pipeline if the quantum layer uses them normalized
+    if stream_data and datatype == "CHANNELS":
+        train_dataset, test_dataset, data_classes = build_channels_datasets(details,details[0],details[5],run["channels"],classes,run["seed"])
+    elif stream_data:
+        train_dataset, test_dataset, data_classes = build_streaming_datasets(datatype,details,classes,run["seed"])
+        # the statistics of the training split take one pass over the stream
+        quantum_layer = pipeline_normalized_layer(model, datatype)
+        if quantum_layer is not None:
+            stats = compute_dataset_channel_stats(train_dataset) if run["normalization"] == "dataset" else None
+            if stats is not None:
+                quantum_layer.channel_stats = [stats[0].tolist(), stats[1].tolist()]
+            train_dataset = train_dataset.map(lambda x, y: (normalize_channels(x,datatype,stats), y))
+            test_dataset = test_dataset.map(lambda x, y: (normalize_channels(x,datatype,stats), y))
+    else:
+        model_data = load_model_data(model,run,details)
+# with a frozen quantum layer only the dense head is trained, it gets its own optimizer and is
+# the only part of the model that is checkpointed
+    trained_model, trained_optimizer = model, optimizer
+    if freeze_quantum:
+        # evaluate the frozen quantum layer once and train the head from the feature store
+        head, train_features, test_features = feature_store.prepare_head(model, model_data[0], model_data[1], global_batch_size)
+        trained_optimizer = tf.keras.optimizers.Adam(learning_rate=global_learning_rate)
+        head.compile(optimizer=trained_optimizer, loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+        trained_model = head
+# checkpoint the weights and the optimizer state every checkpoint_every epochs, with resume the
+# training continues after the last checkpoint of a run with the same settings
+    callbacks = []
+    initial_epoch = 0
+    if run["checkpoint_every"]:
+        checkpoint = checkpoints.Training_checkpoint(trained_model, trained_optimizer, checkpoints.checkpoint_path(run, model.name), run["checkpoint_every"])
+        initial_epoch = checkpoint.restore(run["resume"], run["overwrite"])
+        callbacks.append(checkpoint)
+# time the stages of the quantum layers and the throughput of every epoch, optionally with a profiler trace
+# the head trained from the feature store never calls the quantum layer, so there is nothing to profile
+    if (run["profile"] or run["trace"]) and freeze_quantum:
+        print("Profiling is skipped with freeze_quantum, the head is trained from stored quantum layer outputs")
+    elif run["profile"] or run["trace"]:
+        callbacks.append(profiling.Profiling(model, 'output/'+timestr_, trace=run["trace"]))
 # begin to train the model
-    model_history = model.fit(model_data[0], model_data[2], validation_data=(model_data[1],model_data[3]) , epochs=num_of_epochs, batch_size=global_batch_size)
-# create timestampped folder to save output
-    os.mkdir('output/'+timestr_)
+    if stream_data:
+        model_history = model.fit(train_dataset, validation_data=test_dataset, epochs=num_of_epochs, initial_epoch=initial_epoch, callbacks=callbacks)
+    elif freeze_quantum:
+        model_history = head.fit(train_features, model_data[2], validation_data=(test_features,model_data[3]) , epochs=num_of_epochs, batch_size=global_batch_size, initial_epoch=initial_epoch, callbacks=callbacks)
+    else:
+        model_history = model.fit(model_data[0], model_data[2], validation_data=(model_data[1],model_data[3]) , epochs=num_of_epochs, batch_size=global_batch_size, initial_epoch=initial_epoch, callbacks=callbacks)
+# the history of a resumed run starts at the first epoch
+    if run["checkpoint_every"]:
+        model_history.history = checkpoint.history
+# create timestampped folder to save output and save the trained model, it is reloaded with
+# tf.keras.models.load_model after importing circuits
+    os.makedirs('output/'+timestr_, exist_ok=True)
+    model.save('output/'+timestr_+'/model.keras')
 # Create confusion matrix
     print("CONFUSION MATRIX")
-    classes = model_data[4]
-    y_pred = model.predict(model_data[1])
+    if stream_data:
+        classes = data_classes
+        y_pred = model.predict(test_dataset)
+        y_true = np.concatenate([labels for _, labels in test_dataset])
+    else:
+        classes = model_data[4]
+        if freeze_quantum:
+            y_pred = head.predict(test_features)
+        else:
+            y_pred = model.predict(model_data[1])
+        y_true = np.asarray(model_data[3]).flatten()
+    for name, hit_rate in hit_rates(model).items():
+        print("Cache hit rate of "+name+": "+str(round(hit_rate, 4)))
     y_pred = np.argmax(y_pred, axis=-1)
     y_pred = y_pred.flatten()
-    if datatype == "CHANNELS" or datatype == "CIFAR10":
-        y_true = model_data[3].flatten()
-    else:
-        y_true = model_data[3].numpy().flatten()
     confusion_mtx = confusion_matrix(y_true, y_pred, normalize='true')
     plt.figure(figsize=(16, 16))
     plt.figure()
@@ -157,11 +228,175 @@ def train_model(model_to_train,classes):
     plt.xlabel('Predicted label')
     timestr = time.strftime("%Y%m%d-%H%M%S")
     plt.savefig('output/'+timestr_+'/'+timestr+'_confusion_matrix.png', bbox_inches='tight')
+    plt.close('all')
 
 # create learning curves plot
     print("GENERATE LEARNING CURVES")
     generate_output.save_output_imgs(model,model_history,details,timestr_)
+    return model_history, 'output/'+timestr_
+
+# build the model of a run, bond_dim only applies to the mps backend and channels to CHANNELS
+def build_model(run):
+    if run["normalization"] not in normalization_modes:
+        raise ValueError("Unknown normalization "+str(run["normalization"])+", choose from "+str(list(normalization_modes)))
+    backend_options = {"bond_dim": run["bond_dim"]} if run["bond_dim"] and run["backend"] == "mps" else None
+    return model_builders[run["model"]](run["dataset"],run["classes"],run["image_size"],run["image_size"],backend=run["backend"],normalization=normalization_modes[run["normalization"]],
+                                        fused_kernels=run["fused_kernels"],backend_options=backend_options,devices=run["devices"],
+                                        cache_size=run["cache_size"],channels=run["channels"])
+
+# build and train the model of a single run, returns a summary of the run
+def run_training(run, threads=None):
+    setup_worker(threads, run["devices"])
+    model = build_model(run)
+    model_history, output_dir = train_model(model,run)
+    return dict(run, val_accuracy=model_history.history['val_accuracy'][-1], val_loss=model_history.history['val_loss'][-1], output=output_dir)
+
+# the entry of a run that raised an error, the other runs of a config keep training
+def failed_run(run, error):
+    print("Run "+run["model"]+" "+run["dataset"]+" failed:\n"+"".join(traceback.format_exception(type(error), error, error.__traceback__)))
+    return dict(run, error=type(error).__name__+": "+str(error))
+
+# train every run of a config, runs are distributed over a pool of worker processes. a run that
+# fails is recorded with its error, the results of all runs are returned in the order of the runs
+def run_config(config):
+    runs = expand_config(config)
+    workers = config.get("workers", pool_defaults["workers"])
+    threads = config.get("threads_per_worker", pool_defaults["threads_per_worker"])
+    os.makedirs('output', exist_ok=True)
+    print("Training "+str(len(runs))+" runs on "+str(workers)+" worker(s)")
+
+    results = [None]*len(runs)
+    if workers <= 1:
+        for i, run in enumerate(runs):
+            try:
+                results[i] = run_training(run, threads)
+            except Exception as error:
+                results[i] = failed_run(run, error)
+    else:
+        # tensorflow is not fork safe, workers are started as fresh processes
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = {pool.submit(run_training, run, threads): i for i, run in enumerate(runs)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as error:
+                    results[i] = failed_run(runs[i], error)
+
+    print("~~~~~~~~~~~RESULTS~~~~~~~~~~")
+    for result in results:
+        summary = result["model"]+" "+result["dataset"]+" lr="+str(result["learning_rate"])+" classes="+str(result["classes"])+": "
+        if "error" in result:
+            print(summary+"FAILED "+result["error"])
+        else:
+            print(summary+"val_accuracy="+str(round(result["val_accuracy"],4))+" ("+result["output"]+")")
+    return results
+
+#############################
+# ask for the settings of a run with the original menu
+def interactive_config():
+    print("~~~~~~~~~~~MENU~~~~~~~~~~~~~")
+    print("1: COLORS")
+    print("2: COLORS_SHAPE")
+    print("3: CIFAR-10")
+    print("Note: Run create_noisy_colors.py first if you want to check with synthetic data too.")
+    try:
+        datamenu1 = int(input('Choose dataset to train on (enter number): '))
+    except:
+        datamenu1 = 3
+
+    try:
+        datamenu2 = float(input('Enter learning rate (default 0.001): '))
+    except:
+        datamenu2 = 0.001
+
+    if datamenu1 == 3:
+        try:
+            datamenu3 = int(input('Enter number of CIFAR classes (default 10): '))
+        except:
+            datamenu3 = 10
+    else:
+        datamenu3 = 10
+
+    try:
+        datamenu4 = int(input('Enter image size (default 10, 32 for native CIFAR-10): '))
+    except:
+        datamenu4 = 10
+
+    print("Select models to run sequentially (y/n): ")
+
+    model1 = input('CO-QCNN (U1): ')
+    model2 = input('WEV-QCNN (U1): ')
+    model3 = input('Control QCNN (U1): ')
+    model4 = input('Modified CO-QCNN (U1): ')
+
+    freeze_quantum = input('Freeze the quantum layer and train the dense head on stored features (y/n): ') == "y"
+
+    # the synthetic image folders can be streamed from disk, the feature store needs them in memory
+    stream_data = False
+    if (datamenu1 == 1 or datamenu1 == 2) and not freeze_quantum:
+        stream_data = input('Stream images from disk instead of loading them into memory (y/n): ') == "y"
+
+    resume = input('Resume from the last checkpoint of these settings (y/n): ') == "y"
+    overwrite = not resume and input('Overwrite an existing checkpoint of these settings (y/n): ') == "y"
+
+    print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+
+    selected = [name for name, answer in zip(["CO", "WEV", "control", "modified_CO"], [model1, model2, model3, model4]) if answer == "y"]
+    return {"dataset": {1: "COLORS", 2: "COLORS_SHAPE", 3: "CIFAR10"}.get(datamenu1, "CIFAR10"),
+            "classes": datamenu3,
+            "learning_rate": datamenu2,
+            "image_size": datamenu4,
+            "model": selected,
+            "freeze_quantum": freeze_quantum,
+            "stream_data": stream_data,
+            "resume": resume,
+            "overwrite": overwrite}
+
+# read the config from a json file and command line flags, flags override the file
+def parse_config(argv=None):
+    parser = argparse.ArgumentParser(description="Train the QCNN models. Without arguments the settings are asked for interactively.")
+    parser.add_argument("--config", help="json file with the settings, list values are expanded into one run per combination")
+    parser.add_argument("--datasets", nargs="+", dest="dataset", choices=["COLORS", "COLORS_SHAPE", "CIFAR10", "CHANNELS"])
+    parser.add_argument("--models", nargs="+", dest="model", choices=list(model_builders))
+    parser.add_argument("--classes", nargs="+", type=int)
+    parser.add_argument("--learning-rates", nargs="+", type=float, dest="learning_rate")
+    parser.add_argument("--epochs", nargs="+", type=int)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, dest="batch_size")
+    parser.add_argument("--image-sizes", nargs="+", type=int, dest="image_size")
+    parser.add_argument("--channels", nargs="+", type=int, help="channels of the generated CHANNELS data, at least the number of classes")
+    parser.add_argument("--samples", nargs="+", type=int, help="training samples of the generated CHANNELS data, the test split is a fifth of it")
+    parser.add_argument("--backend")
+    parser.add_argument("--bond-dim", nargs="+", type=int, dest="bond_dim", help="bond dimension of the mps backend")
+    parser.add_argument("--devices", type=int, help="logical devices the circuits of every run are sharded across")
+    parser.add_argument("--cache-size", type=int, help="patches cached by the quantum layers outside of training")
+    parser.add_argument("--normalization", nargs="+", choices=list(normalization_modes), help="channel statistics of the color datasets: training split (default), every image or every batch")
+    parser.add_argument("--fused-kernels", action="store_true", default=None, help="evaluate all kernels of the quantum layer in a single simulator call")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--freeze-quantum", action="store_true", default=None)
+    parser.add_argument("--stream-data", action="store_true", default=None)
+    parser.add_argument("--checkpoint-every", type=int, help="epochs between checkpoints, 0 disables checkpointing")
+    parser.add_argument("--resume", action="store_true", default=None, help="continue runs from their last checkpoint")
+    parser.add_argument("--overwrite", action="store_true", default=None, help="start runs over even if a checkpoint of their settings exists")
+    parser.add_argument("--profile", action="store_true", default=None, help="write the time spent in the stages of the quantum layers to <time>_profile.csv")
+    parser.add_argument("--trace", action="store_true", default=None, help="also write a TF profiler trace of a few steps to the trace folder")
+    parser.add_argument("--workers", type=int, help="number of runs trained at the same time")
+    parser.add_argument("--threads-per-worker", type=int, help="tensorflow threads of every worker")
+    args = parser.parse_args(argv)
+
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    for key, value in vars(args).items():
+        if key != "config" and value is not None:
+            config[key] = value[0] if isinstance(value, list) and len(value) == 1 else value
+    return config
 
-# train all chosen models
-for x in models_to_train:
-    train_model(x,classes)
+if __name__ == "__main__":
+    config = parse_config()
+    if not config:
+        config = interactive_config()
+    results = run_config(config)
+    if any("error" in result for result in results):
+        sys.exit(1)
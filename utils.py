@@ -1,18 +1,66 @@
 import tensorflow as tf
 import numpy as np
 
+# datatypes whose channels are normalized before they are encoded
+normalized_datatypes = ["COLORS", "COLORS_SHAPE"]
+
+# map channel i from [minimum, maximum] to [i/n_channels, (i+1)/n_channels]
+# minimum and maximum broadcast against the tensor, constant channels map to the lower bound
+def scale_channels(tensor, minimum, maximum):
+    tensor = tf.cast(tensor, tf.float32)
+    n_channels = tensor.shape[-1]
+    extent = maximum - minimum
+    t_norm = (tensor - minimum) / tf.where(extent > 0, extent, tf.ones_like(extent))
+    return (t_norm + tf.range(n_channels, dtype=tf.float32)) / n_channels
+
+# normalize every channel with the statistics of the whole batch
 def normalize_tensor_by_index(tensor,datatype):
-    if datatype == "COLORS" or datatype == "COLORS_SHAPES":
-        num_tensors = tensor.shape[-1]
-        intervals = np.linspace(0, 1, num_tensors+1)
-        normalized_tensors = []
-        for i in range(num_tensors):
-            t = tensor[..., i]
-            lower = intervals[i]
-            upper = intervals[i+1]
-            t_norm = (t - tf.reduce_min(t)) / (tf.reduce_max(t) - tf.reduce_min(t))
-            t_norm = t_norm * (upper - lower) + lower
-            normalized_tensors.append(t_norm)
-        return tf.stack(normalized_tensors, axis=-1)
+    if datatype in normalized_datatypes:
+        tensor = tf.cast(tensor, tf.float32)
+        return scale_channels(tensor, tf.reduce_min(tensor, axis=[0, 1, 2]), tf.reduce_max(tensor, axis=[0, 1, 2]))
     else:
-       return tensor
\ No newline at end of file
+       return tensor
+
+# normalize every channel independently of the batch, with the statistics of each sample
+# or with precomputed dataset statistics stats = (minimum, maximum) from compute_channel_stats
+def normalize_channels(tensor,datatype,stats=None):
+    if datatype not in normalized_datatypes:
+        return tensor
+    tensor = tf.cast(tensor, tf.float32)
+    if stats is None:
+        return scale_channels(tensor, tf.reduce_min(tensor, axis=[-3, -2], keepdims=True), tf.reduce_max(tensor, axis=[-3, -2], keepdims=True))
+    return scale_channels(tensor, tf.constant(stats[0], dtype=tf.float32), tf.constant(stats[1], dtype=tf.float32))
+
+# per channel minimum and maximum of a dataset, computed in chunks so memory-mapped arrays
+# are never loaded at once
+def compute_channel_stats(x, chunk_size=10000):
+    minimum = np.full(x.shape[-1], np.inf, dtype=np.float32)
+    maximum = np.full(x.shape[-1], -np.inf, dtype=np.float32)
+    for i in range(0, len(x), chunk_size):
+        chunk = np.asarray(x[i:i+chunk_size], dtype=np.float32).reshape(-1, x.shape[-1])
+        minimum = np.minimum(minimum, chunk.min(axis=0))
+        maximum = np.maximum(maximum, chunk.max(axis=0))
+    return minimum, maximum
+
+# per channel minimum and maximum of the images of a tf.data pipeline of (images, labels) batches
+def compute_dataset_channel_stats(dataset):
+    stats = [compute_channel_stats(x.numpy()) for x, _ in dataset]
+    return np.min([s[0] for s in stats], axis=0), np.max([s[1] for s in stats], axis=0)
+
+# extract every 2x2 stride of an image batch in a single op
+# returns a tensor of shape [batch_size, num_x, num_y, n_input_channels, filter_size*filter_size]
+def extract_patches(tensor, filter_size=2):
+    n_input_channels = tensor.shape[-1]
+
+    # collect all strides at once, pixel data is ordered as [filter_size, filter_size, n_input_channels]
+    patches = tf.image.extract_patches(tensor,
+                                       sizes=[1, filter_size, filter_size, 1],
+                                       strides=[1, 1, 1, 1],
+                                       rates=[1, 1, 1, 1],
+                                       padding='VALID')
+    num_x = tf.shape(patches)[1]
+    num_y = tf.shape(patches)[2]
+
+    # permute pixel data to [n_input_channels, filter_size*filter_size] for each stride
+    patches = tf.reshape(patches, shape=[-1, num_x, num_y, filter_size*filter_size, n_input_channels])
+    return tf.transpose(patches, perm=[0, 1, 2, 4, 3])